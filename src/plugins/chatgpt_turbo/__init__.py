@@ -3,10 +3,12 @@ import httpx
 import nonebot
 import json
 import os
-import copy
-import random
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
 
-from nonebot import on_command, on_message
+from nonebot import on_command, on_message, require
 from nonebot.params import CommandArg
 from nonebot.rule import to_me
 from nonebot.permission import SUPERUSER
@@ -21,8 +23,20 @@ from nonebot.adapters.onebot.v11 import (
 from nonebot.plugin import PluginMetadata
 from openai import AsyncOpenAI
 
-from .config import Config, ConfigError
+from .config import BackendConfig, Config, ConfigError
 from .prompts import prompt_map, default_key
+from .streaming import ChunkSplitter
+from .context import ChatSession, TokenCounter, message_text
+from .images import downscale, fetch_image
+from .limits import Gate, GateRegistry
+from .store import MemorySessionStore, SessionCache, SqliteSessionStore
+from .cache import ResponseCache
+from .router import Backend, Router
+
+require("nonebot_plugin_apscheduler")
+require("nonebot_plugin_localstore")
+from nonebot_plugin_apscheduler import scheduler
+from nonebot_plugin_localstore import get_data_dir
 
 __plugin_meta__ = PluginMetadata(
     name="支持OneAPI、DeepSeek、OpenAI聊天Bot",
@@ -45,25 +59,100 @@ __plugin_meta__ = PluginMetadata(
 plugin_config = Config.parse_obj(nonebot.get_driver().config.dict())
 
 # 检查 API 密钥配置
-if not plugin_config.oneapi_key or plugin_config.oneapi_key == "your-api-key-here":
+if not plugin_config.oneapi_backends and (
+    not plugin_config.oneapi_key or plugin_config.oneapi_key == "your-api-key-here"
+):
     nonebot.logger.warning("ChatGPT Turbo 插件: 未配置 API 密钥，插件将不会正常工作")
     # 不抛出异常，让其他插件正常工作
 else:
     # 只有在配置了有效密钥时才初始化客户端
-    if plugin_config.oneapi_url:
-        client = AsyncOpenAI(
-            api_key=plugin_config.oneapi_key, base_url=plugin_config.oneapi_url
+    backend_configs = plugin_config.oneapi_backends or [
+        BackendConfig(name="default", key=plugin_config.oneapi_key, url=plugin_config.oneapi_url)
+    ]
+    backends = [
+        Backend(
+            backend_config.name,
+            # 多个后端时出错直接切换，不在同一个后端上重试
+            AsyncOpenAI(
+                api_key=backend_config.key,
+                base_url=backend_config.url or None,
+                max_retries=0 if len(backend_configs) > 1 else 2,
+            ),
+            backend_config.model or plugin_config.oneapi_model,
         )
-    else:
-        client = AsyncOpenAI(api_key=plugin_config.oneapi_key)
-
-    model_id = plugin_config.oneapi_model
+        for backend_config in backend_configs
+    ]
+    router = Router(backends, plugin_config.router_ewma_alpha, plugin_config.router_cooldown,
+                    plugin_config.router_hedge_after)
+    # 请求可能由任意一个后端处理，上下文按各后端模型中最小的token上限裁剪
+    context_budget = min(
+        plugin_config.context_token_budgets.get(backend.model, plugin_config.context_token_budget)
+        for backend in backends
+    )
 
 # 客户端和模型配置已在上面处理
 
-# 会话管理
-session = {}
-session_limit = {}
+# 共享的图片下载连接池
+http_client = httpx.AsyncClient(
+    timeout=plugin_config.image_fetch_timeout,
+    limits=httpx.Limits(max_connections=plugin_config.image_max_connections),
+    follow_redirects=True,
+)
+
+@nonebot.get_driver().on_shutdown
+async def _():
+    await http_client.aclose()
+
+# 会话管理：内存中只保留最近使用的会话，其余按需从存储中加载，修改定时批量写回
+token_counter = TokenCounter(plugin_config.oneapi_model)
+if plugin_config.session_store == "memory":
+    session_store = MemorySessionStore()
+else:
+    if plugin_config.session_store != "sqlite":
+        nonebot.logger.warning(f"未知的会话存储{plugin_config.session_store}，回退到sqlite")
+    session_store = SqliteSessionStore(
+        Path(plugin_config.session_store_path or get_data_dir("chatgpt_turbo") / "sessions.db")
+    )
+session = SessionCache(session_store, token_counter, plugin_config.session_cache_max)
+summary_tasks = {}  # 会话id -> 正在生成摘要的任务
+
+@nonebot.get_driver().on_startup
+async def _():
+    await session_store.open()
+    await session.load_limits()
+
+@nonebot.get_driver().on_shutdown
+async def _():
+    await flush_sessions()
+    await session_store.close()
+
+@scheduler.scheduled_job("interval", seconds=plugin_config.session_flush_interval, id="flush_chat_sessions")
+async def flush_sessions():
+    """把修改过的会话写回存储"""
+    try:
+        await session.flush()
+    except Exception as e:
+        nonebot.logger.warning(f"保存会话失败: {e}")
+
+# 重复提问的回复缓存
+response_cache = ResponseCache(
+    plugin_config.cache_max_entries,
+    plugin_config.cache_ttl,
+    plugin_config.cache_context_turns,
+    plugin_config.cache_similarity_threshold,
+) if plugin_config.cache_enabled else None
+
+# 并发控制：同一会话的提问依次处理，上游请求数按全局和群限制
+session_gates = GateRegistry(1, plugin_config.session_queue_max)
+group_gates = GateRegistry(plugin_config.group_max_inflight)
+global_gate = Gate(plugin_config.max_inflight, plugin_config.max_waiting)
+
+@asynccontextmanager
+async def completion_slot(session_id: str):
+    """占用一个上游请求名额，先按群再按全局限制"""
+    async with group_gates.hold(session_id):
+        async with global_gate.hold():
+            yield
 
 # 群组角色管理
 PROMPT_FILE = os.path.join(os.path.dirname(__file__), "group_prompts.json")
@@ -86,11 +175,180 @@ def save_group_prompts():
 # 初始化加载配置
 load_group_prompts()
 
+def forward_node(bot: Bot, name: str, text: str) -> dict:
+    """构造合并转发消息的节点"""
+    return {
+        "type": "node",
+        "data": {
+            "name": name,
+            "uin": bot.self_id,
+            "content": MessageSegment.text(text)
+        }
+    }
+
+async def stream_reply(bot: Bot, event: MessageEvent, msgs: list, vision: bool = False) -> str:
+    """流式获取回复，按配置逐句/逐段发送或结束后合并转发，返回完整回复"""
+    response = await router.create(
+        messages=msgs,
+        vision=vision,
+        stream=True,
+    )
+    # 处理请求的后端返回了思维链时才展示
+    show_reason = plugin_config.r1_reason
+    is_private = isinstance(event, PrivateMessageEvent)
+    forward = plugin_config.stream_chunk_mode == "forward"
+    splitter = ChunkSplitter(plugin_config.stream_chunk_mode, plugin_config.stream_min_chunk_chars)
+    reasoning_parts = []
+    content_parts = []
+    reasoning_sent = False
+    sent_count = 0
+
+    async def send_text(text: str):
+        nonlocal sent_count
+        # 只在第一条消息@用户，避免刷屏
+        await chat_record.send(MessageSegment.text(text), at_sender=sent_count == 0)
+        sent_count += 1
+
+    async def send_nodes(nodes: list):
+        if is_private:
+            for node in nodes:
+                await send_text(node["data"]["content"].data["text"])
+        else:
+            await bot.call_api("send_group_forward_msg", group_id=event.group_id, messages=nodes)
+
+    async def send_reasoning():
+        nonlocal reasoning_sent
+        reasoning_sent = True
+        reasoning = "".join(reasoning_parts)
+        if reasoning:
+            await send_nodes([forward_node(bot, "DeepSeek-R1思维链", ("思维链\n" if is_private else "") + reasoning)])
+
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning = getattr(delta, "reasoning_content", None)
+        if reasoning:
+            reasoning_parts.append(reasoning)
+        if not delta.content:
+            continue
+        content_parts.append(delta.content)
+        if forward:
+            continue
+        if show_reason and not reasoning_sent:
+            # 思维链结束后先发出思维链，再逐条发送回复
+            await send_reasoning()
+        for text in splitter.feed(delta.content):
+            await send_text(text)
+
+    content = "".join(content_parts)
+    if forward:
+        nodes = []
+        reasoning = "".join(reasoning_parts)
+        if show_reason and reasoning:
+            nodes.append(forward_node(bot, "DeepSeek-R1思维链", ("思维链\n" if is_private else "") + reasoning))
+            nodes.append(forward_node(bot, "DeepSeek-R1回复", ("回复\n" if is_private else "") + content))
+        else:
+            nodes.append(forward_node(bot, "回复", content))
+        await send_nodes(nodes)
+    else:
+        if show_reason and not reasoning_sent:
+            await send_reasoning()
+        rest = splitter.flush()
+        if rest:
+            await send_text(rest)
+    return content
+
+async def summarize_dropped(session_id: str, chat_session: ChatSession, dropped: list):
+    """把移出上下文的对话连同已有摘要总结为新的摘要"""
+    history = "\n".join(
+        f"{'用户' if message['role'] == 'user' else '助手'}: {message_text(message)}" for message in dropped
+    )
+    if chat_session.summary:
+        history = f"已有摘要：{chat_session.summary}\n\n{history}"
+    try:
+        async with completion_slot(session_id):
+            response = await router.create(
+                model=plugin_config.context_summary_model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": f"请用中文概括以下对话的要点，保留人物、事实和未完成的话题，"
+                                   f"不超过{plugin_config.context_summary_max_chars}字。",
+                    },
+                    {"role": "user", "content": history},
+                ],
+            )
+        summary = str(response.choices[0].message.content).strip()
+        chat_session.set_summary(summary[:plugin_config.context_summary_max_chars])
+        session.mark_dirty(session_id, chat_session)
+    except Exception as error:
+        nonebot.logger.warning(f"生成对话摘要失败: {error}")
+
+async def summarize_pending(session_id: str, chat_session: ChatSession):
+    """依次总结等待中的消息，同一个会话同时只有一个总结任务"""
+    while chat_session.summary_pending:
+        dropped, chat_session.summary_pending = chat_session.summary_pending, []
+        await summarize_dropped(session_id, chat_session, dropped)
+
+async def clear_session(session_id: str):
+    """删除会话，等待正在处理的提问结束，并取消未完成的摘要任务"""
+    async with session_gates.hold(session_id):
+        task = summary_tasks.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        await session.delete(session_id)
+
+def fit_context(session_id: str, chat_session: ChatSession, message: dict) -> int:
+    """按token预算和消息条数上限从最早的对话开始裁剪上下文，返回本次提问的token数"""
+    tokens = token_counter.count_message(message)
+    dropped = chat_session.trim(context_budget, session.get_limit(session_id), tokens)
+    if dropped and plugin_config.context_summarize:
+        chat_session.summary_pending.extend(dropped)
+        task = summary_tasks.get(session_id)
+        if task is None or task.done():
+            task = asyncio.create_task(summarize_pending(session_id, chat_session))
+            summary_tasks[session_id] = task
+            # 完成后移除，旧任务的回调不删除新任务
+            task.add_done_callback(
+                lambda done: summary_tasks.pop(session_id) if summary_tasks.get(session_id) is done else None
+            )
+    return tokens
+
+async def embed_question(text: str) -> Optional[List[float]]:
+    """计算提问的向量，失败时返回None，只使用精确匹配"""
+    try:
+        return await router.embed(plugin_config.cache_embedding_model, text)
+    except Exception as error:
+        nonebot.logger.warning(f"计算提问向量失败: {error}")
+        return None
+
+async def load_images(urls: list) -> list:
+    """并发下载消息中的图片并缩小，返回data URL列表，下载失败的图片跳过"""
+    async def load(url: str) -> str:
+        data = await fetch_image(http_client, url, plugin_config.image_max_bytes)
+        data, mime = await asyncio.to_thread(
+            downscale, data, plugin_config.image_max_dimension, plugin_config.image_jpeg_quality
+        )
+        return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+    results = await asyncio.gather(
+        *(load(url) for url in urls[:plugin_config.image_max_count]), return_exceptions=True
+    )
+    data_urls = []
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            nonebot.logger.warning(f"下载图片失败 {url}: {result}")
+        else:
+            data_urls.append(result)
+    return data_urls
+
 # 事件处理器
 chat_record = on_message(rule=to_me(), block=True, priority=99)
 clear_request = on_command("clear", block=True, priority=1)
 switch_command = on_command("切换", block=True, priority=1, permission=SUPERUSER)
 change_limit_request = on_command("set_limit", block=True, priority=1, permission=SUPERUSER)
+status_request = on_command("chat_status", block=True, priority=1, permission=SUPERUSER)
 
 @switch_command.handle()
 async def _(bot: Bot, event: MessageEvent, args: Message = CommandArg()):
@@ -105,59 +363,76 @@ async def _(bot: Bot, event: MessageEvent, args: Message = CommandArg()):
     save_group_prompts()
     
     # 清除现有会话
-    if group_id in session:
-        del session[group_id]
+    await clear_session(group_id)
         
     await switch_command.finish(f"已切换至 {prompt_key}")
 
-@chat_record.handle()
-async def _(bot: Bot, event: MessageEvent):
-    """带记忆的聊天处理"""
-    # 私聊检查
-    if isinstance(event, PrivateMessageEvent) and not plugin_config.enable_private_chat:
-        await chat_record.finish("对不起，私聊暂不支持此功能。")
-    
-    content = str(event.get_message())
-    img_url = helpers.extract_image_urls(event.message)
-    
-    if not content or content.strip() == "":
-        await chat_record.finish(MessageSegment.text("内容不能为空！"), at_sender=True)
-    
-    group_id = event.get_session_id().split("_")[1]
-    session_id = group_id
-    
-    # 初始化会话限制
-    if session_id not in session_limit:
-        session_limit[session_id] = 20
-    
-    # 会话长度管理
-    if session_id in session and len(session[session_id]) > session_limit[session_id]:
-        delete_count = random.randint(1, 5)
-        session[session_id] = session[session_id][:1] + session[session_id][1 + 2 * delete_count:]
-    
+async def chat_turn(bot: Bot, event: MessageEvent, content: str, img_url: list, group_id: str, session_id: str):
+    """处理一轮对话，调用方需持有该会话的锁"""
     # 初始化会话
-    if session_id not in session:
-        session[session_id] = []
-        current_prompt = group_prompts.get(group_id, default_key)
-        session[session_id].append({"role": "system", "content": prompt_map[current_prompt]})
+    current_prompt = group_prompts.get(group_id, default_key)
+    chat_session = await session.get_or_create(
+        session_id, lambda: ChatSession(prompt_map[current_prompt], token_counter)
+    )
+
+    # 文字提问先查回复缓存，命中时不请求上游
+    cache_scope = None
+    question_embedding = None
+    if response_cache is not None and not img_url:
+        cache_scope = response_cache.scope(current_prompt, chat_session.snapshot())
+        reply = response_cache.get(cache_scope, content)
+        if reply is None and plugin_config.cache_embedding_model:
+            question_embedding = await embed_question(content)
+            if question_embedding is not None:
+                reply = response_cache.search(cache_scope, question_embedding)
+        if reply is None:
+            response_cache.miss()
+        else:
+            user_message = {"role": "user", "content": content}
+            user_tokens = fit_context(session_id, chat_session, user_message)
+            chat_session.append(user_message, user_tokens)
+            chat_session.append({"role": "assistant", "content": reply})
+            session.mark_dirty(session_id, chat_session)
+            await chat_record.finish(MessageSegment.text(reply), at_sender=True)
 
     # 处理文本消息
-    if not img_url or "deepseek" in model_id:
+    # 没有支持图片的后端时只发送文字
+    if (not img_url or not router.vision) and plugin_config.stream_enabled:
+        user_message = {"role": "user", "content": content}
+        user_tokens = fit_context(session_id, chat_session, user_message)
+        msgs = chat_session.request(user_message)
         try:
-            msgs = copy.deepcopy(session[session_id])
-            msgs.append({"role": "user", "content": content})
-            response = await client.chat.completions.create(
-                model=model_id,
-                messages=msgs,
-            )
+            async with completion_slot(session_id):
+                reply = await stream_reply(bot, event, msgs)
+        except Exception as error:
+            await chat_record.finish(str(error), at_sender=True)
+
+        chat_session.append(user_message, user_tokens)
+        chat_session.append({"role": "assistant", "content": reply})
+        session.mark_dirty(session_id, chat_session)
+        if cache_scope is not None and reply:
+            response_cache.put(cache_scope, content, reply, question_embedding)
+        await chat_record.finish()
+    elif not img_url or not router.vision:
+        user_message = {"role": "user", "content": content}
+        user_tokens = fit_context(session_id, chat_session, user_message)
+        try:
+            msgs = chat_session.request(user_message)
+            async with completion_slot(session_id):
+                response = await router.create(
+                    messages=msgs,
+                )
         except Exception as error:
             await chat_record.finish(str(error), at_sender=True)
             
-        session[session_id].append({"role": "user", "content": content})
-        session[session_id].append({"role": "assistant", "content": response.choices[0].message.content})
+        chat_session.append(user_message, user_tokens)
+        chat_session.append({"role": "assistant", "content": response.choices[0].message.content})
+        session.mark_dirty(session_id, chat_session)
+        if cache_scope is not None and response.choices[0].message.content:
+            response_cache.put(cache_scope, content, response.choices[0].message.content, question_embedding)
         
-        # DeepSeek-R1 思维链处理
-        if model_id == "deepseek-reasoner" and plugin_config.r1_reason:
+        # DeepSeek-R1 思维链处理，按处理请求的后端是否返回了思维链判断
+        if plugin_config.r1_reason and getattr(response.choices[0].message, "reasoning_content", None):
             if isinstance(event, PrivateMessageEvent):
                 await chat_record.send(
                     MessageSegment.text("思维链\n" + str(response.choices[0].message.reasoning_content)),
@@ -194,34 +469,67 @@ async def _(bot: Bot, event: MessageEvent):
     else:
         # 处理图片消息
         try:
-            image_data = base64.b64encode(
-                httpx.get(img_url[0]).content).decode("utf-8")
-            session[session_id].append({
+            data_urls = await load_images(img_url)
+            if not data_urls:
+                raise ValueError("图片下载失败，请稍后再试")
+            user_message = {
                 "role": "user",
-                "content": [
-                    {"type": "text", "text": content},
+                "content": [{"type": "text", "text": content}] + [
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{image_data}"},
-                    },
+                        "image_url": {"url": data_url},
+                    }
+                    for data_url in data_urls
                 ],
-            })
-            response = await client.chat.completions.create(
-                model=model_id, messages=session[session_id]
-            )
+            }
+            user_tokens = fit_context(session_id, chat_session, user_message)
+            chat_session.append(user_message, user_tokens)
+            session.mark_dirty(session_id, chat_session)
+            async with completion_slot(session_id):
+                if plugin_config.stream_enabled:
+                    await stream_reply(bot, event, chat_session.messages(), vision=True)
+                else:
+                    response = await router.create(messages=chat_session.messages(), vision=True)
         except Exception as error:
             await chat_record.finish(str(error), at_sender=True)
-        
+
+        if plugin_config.stream_enabled:
+            await chat_record.finish()
         await chat_record.finish(
             MessageSegment.text(response.choices[0].message.content), at_sender=True
         )
 
+@chat_record.handle()
+async def _(bot: Bot, event: MessageEvent):
+    """带记忆的聊天处理"""
+    # 私聊检查
+    if isinstance(event, PrivateMessageEvent) and not plugin_config.enable_private_chat:
+        await chat_record.finish("对不起，私聊暂不支持此功能。")
+    
+    content = str(event.get_message())
+    img_url = helpers.extract_image_urls(event.message)
+    
+    if not content or content.strip() == "":
+        await chat_record.finish(MessageSegment.text("内容不能为空！"), at_sender=True)
+    
+    group_id = event.get_session_id().split("_")[1]
+    session_id = group_id
+    
+    # 排队已满时直接回复，避免请求堆积
+    if session_gates.full(session_id):
+        await chat_record.finish(MessageSegment.text("前面的问题还在处理中，请稍后再问"), at_sender=True)
+    if global_gate.full():
+        await chat_record.finish(MessageSegment.text("当前提问的人太多了，请稍后再试"), at_sender=True)
+
+    # 同一个会话的提问依次处理，避免并发读写上下文
+    async with session_gates.hold(session_id):
+        await chat_turn(bot, event, content, img_url, group_id, session_id)
+
 @clear_request.handle()
 async def _(event: MessageEvent):
     """清除历史记录"""
     group_id = event.get_session_id().split("_")[1]
-    if group_id in session:
-        del session[group_id]
+    await clear_session(group_id)
     await clear_request.finish(
         MessageSegment.text("成功清除历史记录！"), at_sender=True
     )
@@ -232,11 +540,29 @@ async def _(event: MessageEvent, msg: Message = CommandArg()):
     group_id = event.get_session_id().split("_")[1]
     try:
         limit = int(msg.extract_plain_text().strip())
-        session_limit[group_id] = limit
+        await session.set_limit(group_id, limit)
         await change_limit_request.finish(
             MessageSegment.text(f"对话上限设置为 {limit}"), at_sender=True
         )
     except ValueError:
         await change_limit_request.finish(
             MessageSegment.text("请输入有效的数字！"), at_sender=True
-        ) 
\ No newline at end of file
+        ) 
+
+@status_request.handle()
+async def _():
+    """查看请求并发和排队情况"""
+    lines = [
+        f"上游请求: 进行中 {global_gate.in_flight}/{global_gate.limit}，排队 {global_gate.waiting}",
+        f"活跃会话: {len(session_gates)}",
+        f"内存中的会话: {len(session)}/{plugin_config.session_cache_max}，待保存 {session.dirty_count}",
+    ]
+    lines.append("上游后端:")
+    lines.extend(router.status())
+    if response_cache is not None:
+        lines.append(f"回复缓存: {len(response_cache)} 条，命中 {response_cache.hits}，未命中 {response_cache.misses}")
+    busiest = session_gates.busiest(5)
+    if busiest:
+        lines.append("排队最多的会话:")
+        lines.extend(f"{key}: 处理中 {in_flight}，排队 {waiting}" for key, in_flight, waiting in busiest)
+    await status_request.finish("\n".join(lines))
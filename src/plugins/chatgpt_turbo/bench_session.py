@@ -0,0 +1,87 @@
+"""会话上下文的微基准测试：对比旧的 deepcopy 后追加与只追加的 ChatSession
+
+不依赖nonebot，可以直接运行：
+
+    python src/plugins/chatgpt_turbo/bench_session.py [--groups 300] [--turns 20] [--chars 500]
+"""
+import argparse
+import copy
+import time
+import tracemalloc
+
+try:
+    from .context import ChatSession, TokenCounter
+except ImportError:  # 作为脚本直接运行
+    from context import ChatSession, TokenCounter
+
+
+def make_text(index: int, chars: int) -> str:
+    return (f"第{index}条消息。" + "这是一段用于测试的比较长的对话内容，" * chars)[:chars]
+
+
+def make_turns(turns: int, chars: int, counter: TokenCounter):
+    """预先生成每轮的提问、回复和token数，计时只包含会话本身的开销"""
+    result = []
+    for turn in range(turns):
+        question = {"role": "user", "content": make_text(turn, chars)}
+        answer = {"role": "assistant", "content": make_text(turn, chars)}
+        result.append((question, counter.count_message(question), answer, counter.count_message(answer)))
+    return result
+
+
+def run_deepcopy(prompt: str, turn_messages: list, groups: int, limit: int, counter: TokenCounter):
+    """旧实现：每轮深拷贝整个会话再追加本次提问，超过上限时删除最早的一对消息"""
+    sessions = [[{"role": "system", "content": prompt}] for _ in range(groups)]
+    for question, _, answer, _ in turn_messages:
+        for history in sessions:
+            if len(history) > limit:
+                del history[1:3]
+            msgs = copy.deepcopy(history)
+            msgs.append(dict(question))
+            history.append(dict(question))
+            history.append(dict(answer))
+
+
+def run_session(prompt: str, turn_messages: list, groups: int, limit: int, counter: TokenCounter):
+    """新实现：复用上下文快照生成请求，只追加记录"""
+    sessions = [ChatSession(prompt, counter) for _ in range(groups)]
+    for question, question_tokens, answer, answer_tokens in turn_messages:
+        for chat_session in sessions:
+            question = dict(question)
+            chat_session.trim(10 ** 9, limit, question_tokens)
+            chat_session.request(question)
+            chat_session.append(question, question_tokens)
+            chat_session.append(dict(answer), answer_tokens)
+
+
+def measure(func, *args):
+    """分别测量耗时和内存峰值，tracemalloc会拖慢执行，不与计时同时开启"""
+    started_at = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started_at
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会话上下文微基准测试")
+    parser.add_argument("--groups", type=int, default=300, help="活跃的会话数")
+    parser.add_argument("--turns", type=int, default=20, help="每个会话的对话轮数")
+    parser.add_argument("--chars", type=int, default=500, help="每条消息的字数")
+    parser.add_argument("--limit", type=int, default=20, help="会话消息条数上限")
+    args = parser.parse_args()
+
+    counter = TokenCounter("gpt-4o")
+    prompt = make_text(0, args.chars)
+    turn_messages = make_turns(args.turns, args.chars, counter)
+    total_turns = args.groups * args.turns
+    for name, func in (("deepcopy", run_deepcopy), ("ChatSession", run_session)):
+        elapsed, peak = measure(func, prompt, turn_messages, args.groups, args.limit, counter)
+        print(f"{name:>12}: {elapsed:.3f}s，每轮 {elapsed / total_turns * 1e6:.1f}us，内存峰值 {peak / 1024 / 1024:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
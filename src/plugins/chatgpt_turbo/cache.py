@@ -0,0 +1,106 @@
+import math
+import re
+import time
+from collections import OrderedDict
+from operator import mul
+from typing import Iterable, List, Optional, Tuple
+
+from .context import message_text
+
+# 结尾的标点和语气词不影响问题的含义
+_TRAILING = re.compile(r"[\s？?！!。.~～，,…]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """统一大小写和空白，去掉结尾的标点"""
+    return _TRAILING.sub("", _SPACES.sub(" ", text.strip().lower()))
+
+
+def unit_vector(vector: Iterable[float]) -> List[float]:
+    vector = list(vector)
+    norm = math.sqrt(sum(map(mul, vector, vector)))
+    return [value / norm for value in vector] if norm else vector
+
+
+class CacheEntry:
+    __slots__ = ("scope", "reply", "expires_at", "embedding")
+
+    def __init__(self, scope: str, reply: str, expires_at: float, embedding: Optional[List[float]]):
+        self.scope = scope
+        self.reply = reply
+        self.expires_at = expires_at
+        self.embedding = embedding
+
+
+class ResponseCache:
+    """重复提问的回复缓存：先按规范化后的问题精确匹配，再可选按向量相似度匹配
+
+    scope由角色和最近几轮对话组成，只有scope相同的提问才会互相命中；
+    超过ttl秒的回复失效，条目数超过上限时淘汰最久未使用的回复。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, context_turns: int, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.context_turns = context_turns
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def scope(self, prompt_key: str, history: Iterable[dict]) -> str:
+        """角色加上最近context_turns轮对话，作为缓存的范围"""
+        parts = [prompt_key]
+        if self.context_turns > 0:
+            messages = [message for message in history if message["role"] != "system"]
+            parts.extend(f"{message['role']}:{normalize_question(message_text(message))}"
+                         for message in messages[-self.context_turns * 2:])
+        return "\n".join(parts)
+
+    def get(self, scope: str, question: str) -> Optional[str]:
+        key = (scope, normalize_question(question))
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.reply
+
+    def search(self, scope: str, embedding: List[float]) -> Optional[str]:
+        """在同一scope内找最相似的问题，相似度达到阈值时返回其回复"""
+        now = time.monotonic()
+        embedding = unit_vector(embedding)
+        best_key, best_score = None, self.similarity_threshold
+        for key, entry in self._entries.items():
+            if entry.embedding is None or entry.scope != scope or entry.expires_at < now:
+                continue
+            score = sum(map(mul, embedding, entry.embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        return self._entries[best_key].reply
+
+    def miss(self):
+        self.misses += 1
+
+    def put(self, scope: str, question: str, reply: str, embedding: Optional[List[float]] = None):
+        key = (scope, normalize_question(question))
+        if embedding is not None:
+            embedding = unit_vector(embedding)
+        self._entries[key] = CacheEntry(scope, reply, time.monotonic() + self.ttl, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
@@ -1,5 +1,12 @@
 from pydantic import Extra, BaseModel
-from typing import Optional
+from typing import Dict, List, Optional
+
+
+class BackendConfig(BaseModel, extra=Extra.ignore):
+    name: str  # 后端名称，用于日志和状态显示
+    key: str  # 该后端的KEY
+    url: Optional[str] = None  # 该后端的地址，使用OpenAI官方服务不需要填写
+    model: Optional[str] = None  # 该后端使用的模型，默认与oneapi_model相同
 
 
 class Config(BaseModel, extra=Extra.ignore):
@@ -8,6 +15,38 @@ class Config(BaseModel, extra=Extra.ignore):
     oneapi_model: Optional[str] = "gpt-4o" # （可选）使用的语言大模型，使用识图功能请填写合适的大模型名称
     r1_reason: bool = True # （可选）使用DeepSeek-R1模型时是否展示思维链
     enable_private_chat: bool = True   # 是否开启私聊对话
+    stream_enabled: bool = False  # （可选）是否流式获取回复，边生成边发送
+    stream_chunk_mode: str = "sentence"  # （可选）流式回复的发送方式：sentence（按句）/ paragraph（按段）/ forward（生成完后合并转发）
+    stream_min_chunk_chars: int = 40  # （可选）按句/段发送时每条消息的最少字数，避免刷屏
+    context_token_budget: int = 8000  # （可选）每次请求携带的上下文（含提示词、摘要和本次提问）的token上限
+    context_token_budgets: Dict[str, int] = {}  # （可选）按模型单独设置token上限，如 {"deepseek-reasoner": 16000}
+    context_summarize: bool = False  # （可选）是否把移出上下文的对话总结为摘要保留
+    context_summary_model: Optional[str] = None  # （可选）生成摘要使用的模型，默认与对话模型相同
+    context_summary_max_chars: int = 300  # （可选）摘要的最大字数
+    image_fetch_timeout: float = 10.0  # （可选）下载图片的超时时间（秒）
+    image_max_connections: int = 8  # （可选）下载图片的最大并发连接数
+    image_max_bytes: int = 10 * 1024 * 1024  # （可选）单张图片的大小上限（字节），超过时跳过
+    image_max_count: int = 4  # （可选）每条消息最多识别的图片数
+    image_max_dimension: int = 1024  # （可选）图片发送给模型前缩小到的最大边长（需要Pillow）
+    image_jpeg_quality: int = 85  # （可选）缩小后的JPEG质量
+    max_inflight: int = 8  # （可选）全局同时进行的上游请求数
+    max_waiting: int = 32  # （可选）全局排队等待的请求数上限，超过时直接回复稍后再试
+    group_max_inflight: int = 2  # （可选）每个群同时进行的上游请求数（含生成摘要）
+    session_queue_max: int = 3  # （可选）每个会话排队等待的提问数上限
+    session_store: str = "sqlite"  # （可选）会话存储方式：sqlite（重启后保留上下文）/ memory（只保存在内存中）
+    session_store_path: Optional[str] = None  # （可选）SQLite数据库路径，默认在插件数据目录下的sessions.db
+    session_cache_max: int = 200  # （可选）内存中保留的会话数上限，超过时淘汰最久未使用的会话
+    session_flush_interval: int = 10  # （可选）把修改过的会话写回数据库的间隔（秒）
+    cache_enabled: bool = False  # （可选）是否缓存重复提问的回复，命中时不请求上游
+    cache_max_entries: int = 1000  # （可选）缓存的回复数上限，超过时淘汰最久未使用的回复
+    cache_ttl: int = 3600  # （可选）缓存的回复的有效期（秒）
+    cache_context_turns: int = 0  # （可选）缓存键包含的最近对话轮数，0表示只按角色和问题匹配
+    cache_embedding_model: Optional[str] = None  # （可选）计算提问向量的模型，如 text-embedding-3-small，填写后相似的问题也会命中
+    cache_similarity_threshold: float = 0.95  # （可选）按向量匹配时的相似度阈值
+    oneapi_backends: List[BackendConfig] = []  # （可选）多个上游后端，填写后代替oneapi_key/oneapi_url，按延迟选择并自动切换
+    router_ewma_alpha: float = 0.3  # （可选）平均延迟的平滑系数，越大越看重最近的请求
+    router_cooldown: float = 30.0  # （可选）后端出错后暂停使用的时间（秒），连续出错时加倍
+    router_hedge_after: float = 0.0  # （可选）请求超过该时间（秒）仍未返回时同时向下一个后端请求，0为不开启
 
 
 class ConfigError(Exception):
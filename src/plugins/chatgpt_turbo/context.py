@@ -0,0 +1,142 @@
+from typing import List, Optional, Tuple
+
+try:
+    from nonebot import logger
+except ImportError:  # 基准测试脚本单独运行时不依赖nonebot
+    import logging
+    logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken为可选依赖，未安装时按字符数估算
+    tiktoken = None
+
+MESSAGE_OVERHEAD = 4  # 每条消息的角色和分隔符约占的token数
+IMAGE_TOKENS = 765  # 一张图片按高清模式1024x1024估算
+
+
+class TokenCounter:
+    """计算消息的token数，安装了tiktoken时精确计算，否则按字符估算"""
+
+    def __init__(self, model: str):
+        self._encoding = None
+        if tiktoken is None:
+            return
+        try:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # 非OpenAI模型没有对应的编码，用通用编码近似
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"加载tiktoken编码失败，改为按字符估算: {e}")
+
+    def count_text(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        # 中日韩字符大约一个字一个token，其他字符大约四个一个token
+        wide = sum(1 for char in text if ord(char) >= 0x2E80)
+        return wide + (len(text) - wide + 3) // 4
+
+    def count_message(self, message: dict) -> int:
+        content = message["content"]
+        if isinstance(content, str):
+            return MESSAGE_OVERHEAD + self.count_text(content)
+        tokens = MESSAGE_OVERHEAD
+        for part in content:
+            if part.get("type") == "text":
+                tokens += self.count_text(part["text"])
+            else:
+                tokens += IMAGE_TOKENS
+        return tokens
+
+
+def message_text(message: dict) -> str:
+    """取出消息中的文字部分，图片以占位符代替"""
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return " ".join(part["text"] if part.get("type") == "text" else "[图片]" for part in content)
+
+
+class ChatSession:
+    """一个会话的上下文：系统提示词、之前对话的摘要和对话记录，每条消息的token数在加入时计算并缓存
+
+    对话记录只追加，移除最早的消息只移动起始下标，消息加入后视为只读，
+    请求时直接复用缓存的消息元组，不需要深拷贝。
+    """
+
+    # 已移除的消息达到该数量时压缩记录，释放被移除的消息
+    COMPACT_THRESHOLD = 16
+
+    def __init__(self, prompt: str, counter: TokenCounter):
+        self.counter = counter
+        self.system = {"role": "system", "content": prompt}
+        self.system_tokens = counter.count_message(self.system)
+        self.summary: Optional[str] = None
+        self.summary_message: Optional[dict] = None
+        self.summary_tokens = 0
+        self._log: List[dict] = []  # 对话记录，只追加
+        self._tokens: List[int] = []  # 与_log一一对应的token数
+        self._start = 0  # 仍在上下文中的第一条消息的下标
+        self._snapshot: Optional[Tuple[dict, ...]] = None
+        self.history_tokens = 0
+        self.summary_pending: List[dict] = []  # 已移出上下文、等待总结的消息
+
+    def __len__(self) -> int:
+        return len(self._log) - self._start
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self.summary_tokens + self.history_tokens
+
+    def append(self, message: dict, tokens: Optional[int] = None):
+        if tokens is None:
+            tokens = self.counter.count_message(message)
+        self._log.append(message)
+        self._tokens.append(tokens)
+        self.history_tokens += tokens
+        self._snapshot = None
+
+    def set_summary(self, summary: str):
+        self.summary = summary
+        self.summary_message = {"role": "system", "content": f"之前对话的摘要：{summary}"}
+        self.summary_tokens = self.counter.count_message(self.summary_message)
+        self._snapshot = None
+
+    def snapshot(self) -> Tuple[dict, ...]:
+        """当前上下文的消息元组，内容不变时重复使用"""
+        if self._snapshot is None:
+            prefix = (self.system,) if self.summary_message is None else (self.system, self.summary_message)
+            self._snapshot = prefix + tuple(self._log[self._start:])
+        return self._snapshot
+
+    def messages(self) -> List[dict]:
+        """发送给模型的完整消息列表"""
+        return list(self.snapshot())
+
+    def request(self, message: dict) -> List[dict]:
+        """在当前上下文后加上本次提问，得到请求的消息列表，会话本身不变"""
+        return [*self.snapshot(), message]
+
+    def trim(self, budget: int, max_messages: int, extra_tokens: int = 0) -> List[dict]:
+        """从最早的消息开始移除，直到加上本次提问不超过token预算和消息条数上限，返回被移除的消息"""
+        dropped = []
+        while len(self) and (self.total_tokens + extra_tokens > budget or len(self) + 1 > max_messages):
+            dropped.append(self._pop_oldest())
+        # 不以助手的回复开头
+        while len(self) and self._log[self._start]["role"] == "assistant":
+            dropped.append(self._pop_oldest())
+        if dropped:
+            self._snapshot = None
+            if self._start >= self.COMPACT_THRESHOLD:
+                del self._log[:self._start]
+                del self._tokens[:self._start]
+                self._start = 0
+        return dropped
+
+    def _pop_oldest(self) -> dict:
+        message = self._log[self._start]
+        self.history_tokens -= self._tokens[self._start]
+        self._start += 1
+        return message
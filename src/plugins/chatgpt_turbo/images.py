@@ -0,0 +1,69 @@
+from io import BytesIO
+from typing import Tuple
+
+import httpx
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow为可选依赖，未安装时不缩小图片
+    Image = None
+
+_MAGIC_TYPES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def guess_mime(data: bytes) -> str:
+    """根据文件头判断图片类型"""
+    for magic, mime in _MAGIC_TYPES:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+async def fetch_image(client: httpx.AsyncClient, url: str, max_bytes: int) -> bytes:
+    """流式下载图片，超过大小上限时中止"""
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        length = response.headers.get("content-length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ImageTooLarge(f"图片过大（{int(length) // 1024}KB）")
+        data = bytearray()
+        async for chunk in response.aiter_bytes():
+            data += chunk
+            if len(data) > max_bytes:
+                raise ImageTooLarge(f"图片超过{max_bytes // 1024}KB")
+    return bytes(data)
+
+
+def downscale(data: bytes, max_dimension: int, quality: int) -> Tuple[bytes, str]:
+    """把图片缩小到最大边长以内并转为JPEG，返回(图片数据, MIME类型)，在线程中执行"""
+    if Image is None:
+        return data, guess_mime(data)
+    with Image.open(BytesIO(data)) as img:
+        small_enough = max(img.size) <= max_dimension
+        # 动图只取第一帧
+        if small_enough and img.format == "JPEG":
+            return data, "image/jpeg"
+        frame = img.convert("RGBA") if img.mode in ("P", "LA", "RGBA") else img.convert("RGB")
+        frame.thumbnail((max_dimension, max_dimension))
+        if frame.mode == "RGBA":
+            # JPEG不支持透明通道，铺白色背景
+            background = Image.new("RGB", frame.size, (255, 255, 255))
+            background.paste(frame, mask=frame.getchannel("A"))
+            frame = background
+        output = BytesIO()
+        frame.save(output, format="JPEG", quality=quality, optimize=True)
+    result = output.getvalue()
+    if small_enough and len(result) >= len(data):
+        return data, guess_mime(data)
+    return result, "image/jpeg"
@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+class Gate:
+    """带排队计数的信号量，limit为同时进行的数量，max_waiting为排队上限（小于0不限制）"""
+
+    def __init__(self, limit: int, max_waiting: int = -1):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.waiting = 0
+        # 在事件循环中第一次使用时创建，避免绑定到导入时的事件循环
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and self.waiting == 0
+
+    def full(self) -> bool:
+        """已经没有空闲名额且排队已满"""
+        return 0 <= self.max_waiting <= self.waiting and self.in_flight >= self.limit
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+
+class GateRegistry:
+    """按key（会话或群）分配Gate，空闲的Gate在释放后删除"""
+
+    def __init__(self, limit: int, max_waiting: int = -1):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self._gates: Dict[str, Gate] = {}
+
+    def get(self, key: str) -> Gate:
+        gate = self._gates.get(key)
+        if gate is None:
+            gate = self._gates[key] = Gate(self.limit, self.max_waiting)
+        return gate
+
+    def full(self, key: str) -> bool:
+        gate = self._gates.get(key)
+        return gate is not None and gate.full()
+
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        gate = self.get(key)
+        try:
+            async with gate.hold():
+                yield
+        finally:
+            if gate.idle and self._gates.get(key) is gate:
+                del self._gates[key]
+
+    def busiest(self, count: int) -> List[Tuple[str, int, int]]:
+        """排队最多的key，返回(key, 进行中, 排队)"""
+        gates = sorted(self._gates.items(), key=lambda item: (item[1].waiting, item[1].in_flight), reverse=True)
+        return [(key, gate.in_flight, gate.waiting) for key, gate in gates[:count]]
+
+    def __len__(self) -> int:
+        return len(self._gates)
@@ -0,0 +1,73 @@
+"""本地模拟的OpenAI兼容后端，用于测试多后端的延迟选择、对冲请求和故障切换
+
+不依赖nonebot，可以直接运行，然后把 oneapi_backends 的 url 指向 http://127.0.0.1:端口/v1：
+
+    python src/plugins/chatgpt_turbo/mock_backend.py --port 8001 --delay 0.2
+    python src/plugins/chatgpt_turbo/mock_backend.py --port 8002 --delay 2 --error-rate 0.5 --status 429
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(name: str, delay: float, error_rate: float, status: int) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(delay)
+        if random.random() < error_rate:
+            return JSONResponse({"error": {"message": f"{name} 模拟错误", "type": "mock_error"}}, status_code=status)
+
+        question = body["messages"][-1]["content"]
+        reply = f"[{name}] 收到：{question if isinstance(question, str) else '图片消息'}"
+        completion_id = f"chatcmpl-{name}-{int(time.time() * 1000)}"
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            }
+
+        async def events():
+            for char in reply:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": char}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(0.01)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的OpenAI兼容后端")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--name", default=None, help="后端名称，显示在回复中，默认为mock-端口")
+    parser.add_argument("--delay", type=float, default=0.2, help="每个请求的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的比例")
+    parser.add_argument("--status", type=int, default=500, help="返回错误时的状态码，如429或500")
+    args = parser.parse_args()
+
+    app = create_app(args.name or f"mock-{args.port}", args.delay, args.error_rate, args.status)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
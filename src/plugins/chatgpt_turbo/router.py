@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import openai
+from nonebot import logger
+from openai import AsyncOpenAI
+
+
+def retryable(error: BaseException) -> bool:
+    """限流、服务端错误和连接错误换一个后端重试，其他错误（如参数错误）直接抛出"""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class Backend:
+    """一个OpenAI兼容的上游，记录平滑后的延迟和健康状态"""
+
+    def __init__(self, name: str, client: AsyncOpenAI, model: str):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.vision = "deepseek" not in model  # DeepSeek的模型不支持图片输入
+        self.latency: Optional[float] = None  # 指数加权平均的延迟（秒），还没有成功请求时为None
+        self.failures = 0  # 连续失败次数
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+
+class Router:
+    """在多个后端之间选择上游
+
+    按平均延迟从低到高尝试，出错的后端暂停一段时间；请求超过hedge_after秒仍未返回时，同时向下一个后端发出对冲请求，取先成功的结果；
+    遇到限流或服务端错误时立即换下一个后端。
+    """
+
+    def __init__(self, backends: List[Backend], alpha: float, cooldown: float, hedge_after: float):
+        self.backends = backends
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.hedge_after = hedge_after
+
+    @property
+    def vision(self) -> bool:
+        """是否有支持图片输入的后端"""
+        return any(backend.vision for backend in self.backends)
+
+    def ordered(self) -> List[Backend]:
+        """健康的后端在前，没有延迟数据的后端先试；全部不健康时仍按顺序尝试"""
+        now = time.monotonic()
+        return sorted(
+            self.backends,
+            key=lambda backend: (not backend.healthy(now), backend.latency or 0.0),
+        )
+
+    async def create(self, model: Optional[str] = None, vision: bool = False, **kwargs):
+        """调用chat.completions.create，model为None时使用各后端自己的模型，vision为True时只使用支持图片的后端"""
+        candidates = [backend for backend in self.ordered() if backend.vision or not vision]
+        if not candidates:
+            raise ValueError("没有支持识图的后端")
+        pending = set()
+        started = 0
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            nonlocal started
+            backend = candidates[started]
+            started += 1
+            pending.add(asyncio.create_task(self._attempt(backend, model or backend.model, kwargs)))
+
+        launch()
+        try:
+            while pending:
+                hedge = self.hedge_after > 0 and started < len(candidates)
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_after if hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # 超过阈值仍未返回，向下一个后端发出对冲请求
+                    launch()
+                    continue
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    if not retryable(error):
+                        raise error
+                    last_error = error
+                if started < len(candidates):
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def embed(self, model: str, text: str) -> List[float]:
+        """计算文本的向量，按顺序尝试各后端，出错时换下一个后端"""
+        last_error: Optional[BaseException] = None
+        for backend in self.ordered():
+            try:
+                response = await backend.client.embeddings.create(model=model, input=text)
+                return response.data[0].embedding
+            except Exception as error:
+                if not retryable(error):
+                    raise
+                last_error = error
+        raise last_error
+
+    async def _attempt(self, backend: Backend, model: str, kwargs: dict):
+        backend.requests += 1
+        started_at = time.monotonic()
+        try:
+            response = await backend.client.chat.completions.create(model=model, **kwargs)
+        except asyncio.CancelledError:
+            # 被更快的对冲请求取消，已经等待的时间是延迟的下限
+            self._observe(backend, time.monotonic() - started_at)
+            raise
+        except Exception as error:
+            if retryable(error):
+                backend.errors += 1
+                backend.failures += 1
+                # 连续失败时暂停时间加倍，最多8倍
+                backend.unhealthy_until = time.monotonic() + self.cooldown * min(2 ** (backend.failures - 1), 8)
+                logger.warning(f"后端{backend.name}请求失败，暂停使用: {error}")
+            raise
+        self._observe(backend, time.monotonic() - started_at)
+        backend.failures = 0
+        backend.unhealthy_until = 0.0
+        return response
+
+    def _observe(self, backend: Backend, latency: float):
+        backend.latency = latency if backend.latency is None else \
+            self.alpha * latency + (1 - self.alpha) * backend.latency
+
+    def status(self) -> List[str]:
+        now = time.monotonic()
+        lines = []
+        for backend in self.ordered():
+            latency = "-" if backend.latency is None else f"{backend.latency:.2f}s"
+            state = "正常" if backend.healthy(now) else f"暂停 {backend.unhealthy_until - now:.0f}s"
+            lines.append(f"{backend.name}({backend.model}): {state}，延迟 {latency}，"
+                         f"请求 {backend.requests}，失败 {backend.errors}")
+        return lines
@@ -0,0 +1,237 @@
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+import aiosqlite
+from nonebot import logger
+
+from .context import ChatSession, TokenCounter
+
+
+class MemorySessionStore:
+    """只保存在内存中的会话存储，重启后丢失，用于测试或不需要持久化时"""
+
+    def __init__(self):
+        self._data: Dict[str, str] = {}
+        self._limits: Dict[str, int] = {}
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def load(self, session_id: str) -> Optional[str]:
+        return self._data.get(session_id)
+
+    async def save_many(self, items: Iterable[Tuple[str, str]]):
+        self._data.update(items)
+
+    async def delete(self, session_id: str):
+        self._data.pop(session_id, None)
+
+    async def load_limits(self) -> Dict[str, int]:
+        return dict(self._limits)
+
+    async def save_limit(self, session_id: str, limit: int):
+        self._limits[session_id] = limit
+
+
+class SqliteSessionStore:
+    """保存在SQLite中的会话存储，每个会话一行JSON，消息条数上限单独保存，清除会话后保留"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._connection: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = await aiosqlite.connect(self.path)
+        await self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS chat_session_limits (
+                session_id TEXT PRIMARY KEY,
+                max_messages INTEGER NOT NULL
+            )
+        ''')
+        await self._connection.commit()
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def load(self, session_id: str) -> Optional[str]:
+        cursor = await self._connection.execute('SELECT data FROM chat_sessions WHERE session_id=?', (session_id,))
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0] if row else None
+
+    async def save_many(self, items: Iterable[Tuple[str, str]]):
+        await self._connection.executemany('''
+            INSERT INTO chat_sessions (session_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (session_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at
+        ''', list(items))
+        await self._connection.commit()
+
+    async def delete(self, session_id: str):
+        await self._connection.execute('DELETE FROM chat_sessions WHERE session_id=?', (session_id,))
+        await self._connection.commit()
+
+    async def load_limits(self) -> Dict[str, int]:
+        cursor = await self._connection.execute('SELECT session_id, max_messages FROM chat_session_limits')
+        rows = await cursor.fetchall()
+        await cursor.close()
+        return dict(rows)
+
+    async def save_limit(self, session_id: str, limit: int):
+        await self._connection.execute('''
+            INSERT INTO chat_session_limits (session_id, max_messages) VALUES (?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET max_messages=excluded.max_messages
+        ''', (session_id, limit))
+        await self._connection.commit()
+
+
+def dump_session(chat_session: ChatSession) -> str:
+    """序列化会话，图片只保留占位符，避免base64数据写入数据库"""
+    messages = []
+    for message in chat_session.snapshot()[2 if chat_session.summary_message is not None else 1:]:
+        content = message["content"]
+        if not isinstance(content, str):
+            content = [part if part.get("type") == "text" else {"type": "text", "text": "[图片]"} for part in content]
+        messages.append({"role": message["role"], "content": content})
+    return json.dumps({
+        "prompt": chat_session.system["content"],
+        "summary": chat_session.summary,
+        "messages": messages,
+    }, ensure_ascii=False)
+
+
+def load_session(data: str, counter: TokenCounter) -> ChatSession:
+    state = json.loads(data)
+    chat_session = ChatSession(state["prompt"], counter)
+    if state.get("summary"):
+        chat_session.set_summary(state["summary"])
+    for message in state["messages"]:
+        chat_session.append(message)
+    return chat_session
+
+
+class SessionCache:
+    """会话的内存缓存：按需从存储中加载，超过上限时淘汰最久未使用的会话，修改先记为脏数据再批量写回"""
+
+    DEFAULT_LIMIT = 20  # 未设置时的消息条数上限
+
+    def __init__(self, store, counter: TokenCounter, max_sessions: int):
+        self.store = store
+        self.counter = counter
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._evicted: Dict[str, str] = {}  # 已淘汰但尚未写回的会话
+        self._flushing: Optional[Dict[str, str]] = None  # 正在写回的数据，写入失败时放回
+        self.limits: Dict[str, int] = {}  # 通过set_limit设置过上限的会话
+
+    async def load_limits(self):
+        self.limits = await self.store.load_limits()
+
+    def get_limit(self, session_id: str) -> int:
+        return self.limits.get(session_id, self.DEFAULT_LIMIT)
+
+    async def set_limit(self, session_id: str, limit: int):
+        self.limits[session_id] = limit
+        await self.store.save_limit(session_id, limit)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty) + len(self._evicted)
+
+    async def get(self, session_id: str) -> Optional[ChatSession]:
+        chat_session = self._sessions.get(session_id)
+        if chat_session is not None:
+            self._sessions.move_to_end(session_id)
+            return chat_session
+        # 尚未写回的会话直接从待写数据中恢复
+        data = self._evicted.pop(session_id, None)
+        dirty = data is not None
+        if data is None:
+            data = await self.store.load(session_id)
+        if data is None:
+            return None
+        try:
+            chat_session = load_session(data, self.counter)
+        except (ValueError, KeyError) as e:
+            logger.warning(f"读取会话{session_id}失败: {e}")
+            return None
+        self._put(session_id, chat_session)
+        if dirty:
+            self._dirty.add(session_id)
+        return chat_session
+
+    async def get_or_create(self, session_id: str, factory: Callable[[], ChatSession]) -> ChatSession:
+        chat_session = await self.get(session_id)
+        if chat_session is None:
+            chat_session = factory()
+            self._put(session_id, chat_session)
+            self._dirty.add(session_id)
+        return chat_session
+
+    def mark_dirty(self, session_id: str, chat_session: ChatSession):
+        """会话被修改后调用，处理过程中被淘汰的会话会重新放回缓存"""
+        if self._sessions.get(session_id) is not chat_session:
+            self._evicted.pop(session_id, None)
+            self._put(session_id, chat_session)
+        self._dirty.add(session_id)
+
+    async def delete(self, session_id: str):
+        """删除会话的对话记录，消息条数上限保留"""
+        self._sessions.pop(session_id, None)
+        self._dirty.discard(session_id)
+        self._evicted.pop(session_id, None)
+        if self._flushing is not None:
+            self._flushing.pop(session_id, None)
+        await self.store.delete(session_id)
+
+    async def flush(self):
+        """把脏数据批量写回存储，写入失败时放回，等待下次写回"""
+        pending: Dict[str, str] = dict(self._evicted)
+        self._evicted.clear()
+        for session_id in self._dirty:
+            chat_session = self._sessions.get(session_id)
+            if chat_session is not None:
+                pending[session_id] = dump_session(chat_session)
+        self._dirty.clear()
+        if not pending:
+            return
+        self._flushing = pending
+        try:
+            await self.store.save_many(list(pending.items()))
+        except Exception:
+            # 写入期间被删除的会话已从pending中移除；仍在内存中的重新标记，已淘汰的放回待写数据
+            for session_id, data in pending.items():
+                if session_id in self._sessions:
+                    self._dirty.add(session_id)
+                else:
+                    self._evicted.setdefault(session_id, data)
+            raise
+        finally:
+            self._flushing = None
+
+    def _put(self, session_id: str, chat_session: ChatSession):
+        self._sessions[session_id] = chat_session
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            if evicted_id in self._dirty:
+                self._dirty.discard(evicted_id)
+                self._evicted[evicted_id] = dump_session(evicted)
@@ -0,0 +1,40 @@
+from typing import List, Optional
+
+# 句子结束的标点，换行也视为一句结束
+SENTENCE_ENDINGS = "。！？!?；;…\n"
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+class ChunkSplitter:
+    """把流式返回的文本按句或按段切分成适合逐条发送的消息"""
+
+    def __init__(self, mode: str, min_chars: int):
+        self.mode = mode
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def _boundary(self) -> int:
+        """返回最后一个可切分位置（切分点之后的下标），没有时返回-1"""
+        if self.mode == "paragraph":
+            index = self._buffer.rfind(PARAGRAPH_SEPARATOR)
+            return -1 if index < 0 else index + len(PARAGRAPH_SEPARATOR)
+        for index in range(len(self._buffer) - 1, -1, -1):
+            if self._buffer[index] in SENTENCE_ENDINGS:
+                return index + 1
+        return -1
+
+    def feed(self, text: str) -> List[str]:
+        """追加文本，返回已经可以发送的消息"""
+        self._buffer += text
+        if len(self._buffer) < self.min_chars:
+            return []
+        boundary = self._boundary()
+        if boundary < self.min_chars:
+            return []
+        chunk, self._buffer = self._buffer[:boundary].strip(), self._buffer[boundary:]
+        return [chunk] if chunk else []
+
+    def flush(self) -> Optional[str]:
+        """返回剩余的文本"""
+        chunk, self._buffer = self._buffer.strip(), ""
+        return chunk or None
@@ -14,6 +14,10 @@ class FollowerConfig(BaseModel):
     # 缓存设置
     cache_enabled: bool = True
     cache_ttl: int = 300  # 5分钟缓存
+
+    # 图表发送设置
+    chart_send_mode: str = "base64"  # base64：bot下载后编码发送；url：OneBot端直接从API拉取图表
+    chart_url_base: Optional[str] = None  # url模式下OneBot端访问API的地址，默认同api_base_url
     
     # 日志设置
     log_level: str = "INFO"
@@ -13,15 +13,20 @@ from nonebot.exception import FinishedException
 import asyncio
 import json
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Type
+from nonebot.matcher import Matcher
 
 # 激活驱动器
 driver = get_driver()
 
 from .config import FollowerConfig
 
-# 加载配置
-config = FollowerConfig()
+# 加载配置：从.env中读取带follower_前缀的项，如 FOLLOWER_CHART_SEND_MODE=url，避免与其他插件的同名配置冲突
+config = FollowerConfig.parse_obj({
+    key[len("follower_"):]: value
+    for key, value in driver.config.dict().items()
+    if key.startswith("follower_")
+})
 
 # 创建 HTTP 客户端
 http_client = httpx.AsyncClient(timeout=config.api_timeout)
@@ -67,6 +72,27 @@ async def call_api(endpoint: str, method: str = "GET", data: Optional[dict] = No
         logger.error(f"Unexpected error in API call: {e}")
         raise
 
+async def send_chart(matcher: Type[Matcher], endpoint: str) -> bool:
+    """发送图表，url模式下由OneBot端直接下载，失败时回退到base64"""
+    if config.chart_send_mode == "url":
+        try:
+            base_url = config.chart_url_base or config.api_base_url
+            await matcher.send(MessageSegment.image(f"{base_url}{endpoint}"))
+            return True
+        except Exception as e:
+            logger.warning(f"Chart url send failed, falling back to base64: {e}")
+
+    # 图表API直接返回图片数据
+    chart_response = await call_api(endpoint, return_json=False)
+
+    if chart_response and chart_response.get("content"):
+        # 将二进制图片数据转换为base64
+        import base64
+        image_data = base64.b64encode(chart_response["content"]).decode()
+        await matcher.send(MessageSegment.image(f"base64://{image_data}"))
+        return True
+    return False
+
 # 注册指令：查询所有用户
 list_users = on_command("list_users", aliases={"用户列表", "查看用户"}, priority=5)
 
@@ -329,15 +355,7 @@ async def handle_generate_chart(event: MessageEvent, args: Message = CommandArg(
         # 调用外部 API 生成图表
         logger.info(f"Generating chart for {platform}/{username}")
         
-        # 图表API直接返回图片数据
-        chart_response = await call_api(f"/api/chart/{platform}/{username}", return_json=False)
-        
-        if chart_response and chart_response.get("content"):
-            # 将二进制图片数据转换为base64
-            import base64
-            image_data = base64.b64encode(chart_response["content"]).decode()
-            await generate_chart.send(MessageSegment.image(f"base64://{image_data}"))
-        else:
+        if not await send_chart(generate_chart, f"/api/chart/{platform}/{username}"):
             await generate_chart.finish("图表生成失败")
 
     except FinishedException:
@@ -490,15 +508,7 @@ async def handle_generate_comparison_chart(event: MessageEvent, args: Message =
         query_string = "&".join([f"{k}={v}" for k, v in params.items()])
         endpoint = f"/api/compare/chart?{query_string}"
         
-        # 图表API直接返回图片数据
-        chart_response = await call_api(endpoint, return_json=False)
-        
-        if chart_response and chart_response.get("content"):
-            # 将二进制图片数据转换为base64
-            import base64
-            image_data = base64.b64encode(chart_response["content"]).decode()
-            await generate_comparison_chart.send(MessageSegment.image(f"base64://{image_data}"))
-        else:
+        if not await send_chart(generate_comparison_chart, endpoint):
             await generate_comparison_chart.finish("比较图表生成失败")
 
     except FinishedException:
@@ -60,7 +60,8 @@ PLUGIN_HELP = {
             "@机器人 [消息]": "与机器人对话（带上下文记忆）",
             "clear": "清除当前群组的聊天记录",
             "切换 [角色名]": "切换角色（仅管理员）",
-            "set_limit [数字]": "设置对话上限（仅管理员）"
+            "set_limit [数字]": "设置对话上限（仅管理员）",
+            "chat_status": "查看请求并发和排队情况（仅管理员）"
         },
         "roles": ["小日向美香（默认）", "樱井阳菜", "铃原希实", "羊宫妃那"],
         "examples": [
@@ -79,8 +80,17 @@ PLUGIN_HELP = {
             "/添加词条 [词条名]": "创建新词条（需要管理员权限）",
             "/添加alias [词条名] [别名]": "为词条添加别名",
             "/删除alias [别名]": "删除别名（需要管理员权限）",
+            "/重建索引 [词条名]": "重建图片索引（需要管理员权限）",
+            "/设置模式 [词条名] [模式]": "设置词条的图片选取模式（需要管理员权限）",
+            "/导入 [路径] [词条名]": "从目录或压缩包批量导入图片（需要管理员权限）",
+            "/导出 [路径] [词条名...]": "批量导出图片到压缩包（需要管理员权限）",
+            "/迁移存储": "迁移旧图片到内容寻址存储（需要管理员权限）",
+            "/核对存储": "核对数据库统计与磁盘文件（需要管理员权限）",
             "/checknsy": "查看各词条的图片数量",
-            "/check_count [参数]": "查看使用统计"
+            "/查重 [词条名]": "列出词条中近似重复的图片",
+            "/check_count [参数]": "查看使用统计",
+            "/重建统计": "根据使用日志重建统计（需要管理员权限）",
+            "/图片缓存 [clear]": "查看或清空图片缓存统计"
         },
         "examples": [
             "capoo",
@@ -0,0 +1,273 @@
+"""randpic图库批量导入/导出工具
+
+可以脱离bot单独运行（bot运行中也可以使用，数据库写入按批提交）：
+
+    python src/plugins/randpic/bulk.py import <目录或压缩包> [-k 词条] [--store data/randpic]
+    python src/plugins/randpic/bulk.py export <输出文件.tar|.tar.gz|.zip> [-k 词条 ...] [--store data/randpic]
+
+导入时不指定词条，则以目录/压缩包中的第一级目录名作为词条，与导出的目录结构一致。
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+try:
+    from .storage import BLOB_DIR_NAME, guess_extension, blob_relpath, find_blob, write_blob, copy_to_blob
+    from .phash import Image, BKTree, dhash, hash_to_hex, hex_to_hash
+except ImportError:  # 作为脚本直接运行
+    from storage import BLOB_DIR_NAME, guess_extension, blob_relpath, find_blob, write_blob, copy_to_blob
+    from phash import Image, BKTree, dhash, hash_to_hex, hex_to_hash
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
+
+# 待处理的图片：(在来源中的相对路径, 文件路径或压缩包中读出的内容)
+Item = Tuple[str, Union[str, bytes]]
+
+
+def _hash_item(source: Union[str, bytes], with_phash: bool) -> Tuple[str, str, int, Optional[str]]:
+    """在子进程中计算 (md5, 扩展名, 大小, 感知哈希)"""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            data = f.read()
+    else:
+        data = source
+    phash = dhash(data) if with_phash else None
+    return (hashlib.md5(data).hexdigest(), guess_extension(data), len(data),
+            hash_to_hex(phash) if phash is not None else None)
+
+
+def iter_source(source: Path) -> Iterator[Item]:
+    """遍历目录或压缩包中的图片，压缩包按流式读取"""
+    if source.is_dir():
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = Path(dirpath) / filename
+                if path.suffix.lower() in IMAGE_EXTENSIONS:
+                    yield path.relative_to(source).as_posix(), str(path)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and PurePosixPath(info.filename).suffix.lower() in IMAGE_EXTENSIONS:
+                    yield info.filename, zf.read(info)
+    else:
+        with tarfile.open(str(source), mode="r|*") as tf:
+            for member in tf:
+                if member.isfile() and PurePosixPath(member.name).suffix.lower() in IMAGE_EXTENSIONS:
+                    yield member.name, tf.extractfile(member).read()
+
+
+def _keyword_of(name: str) -> Optional[str]:
+    parts = PurePosixPath(name).parts
+    parts = parts[1:] if parts and parts[0] == "." else parts
+    if len(parts) < 2 or parts[0] == BLOB_DIR_NAME:
+        return None
+    return parts[0]
+
+
+class _KeywordState:
+    """导入过程中每个词条的id、已有md5和感知哈希"""
+
+    def __init__(self, conn: sqlite3.Connection, store: Path, name: str, load_phash: bool):
+        (store / name).mkdir(parents=True, exist_ok=True)
+        conn.execute('INSERT OR IGNORE INTO keywords (name) VALUES (?)', (name,))
+        self.id = conn.execute('SELECT id FROM keywords WHERE name=?', (name,)).fetchone()[0]
+        self.md5s: Set[str] = set()
+        self.tree = BKTree()
+        for fmd5, phash in conn.execute('SELECT md5, phash FROM pictures WHERE keyword_id=?', (self.id,)):
+            self.md5s.add(fmd5)
+            if load_phash and phash:
+                self.tree.add(hex_to_hash(phash), fmd5)
+        self.added = 0
+        self.added_bytes = 0
+
+
+def import_images(store: Path, source: Path, keyword: Optional[str] = None, workers: Optional[int] = None,
+                  batch_size: int = 500, with_phash: bool = True, phash_threshold: int = -1) -> Dict:
+    """把目录或压缩包中的图片导入到词条，返回统计结果"""
+    if keyword == BLOB_DIR_NAME:
+        raise ValueError(f'"{keyword}"为保留名称')
+    with_phash = with_phash and Image is not None
+    conn = sqlite3.connect(store / "data.db", timeout=30)
+    keywords: Dict[str, _KeywordState] = {}
+    pending_rows: List[Tuple[int, str, str, int, Optional[str]]] = []
+    result = {"added": 0, "duplicate": 0, "similar": 0, "failed": 0, "bytes": 0}
+    started_at = time.time()
+
+    def flush():
+        # 一批图片的插入和词条统计更新在同一个事务中提交
+        conn.executemany('INSERT OR IGNORE INTO pictures (keyword_id, md5, path, size, phash) VALUES (?, ?, ?, ?, ?)',
+                         pending_rows)
+        for state in keywords.values():
+            if state.added:
+                conn.execute('UPDATE keywords SET pic_count = pic_count + ?, total_bytes = total_bytes + ? WHERE id=?',
+                             (state.added, state.added_bytes, state.id))
+                state.added = state.added_bytes = 0
+        conn.commit()
+        pending_rows.clear()
+
+    def store_item(name: str, source_data: Union[str, bytes], hashed: Tuple[str, str, int, Optional[str]]):
+        fmd5, extension, size, phash = hashed
+        command = keyword or _keyword_of(name)
+        if command is None:
+            print(f"{name}: 不在词条目录中，跳过", file=sys.stderr)
+            result["failed"] += 1
+            return
+        state = keywords.get(command)
+        if state is None:
+            state = keywords[command] = _KeywordState(conn, store, command, phash_threshold >= 0)
+        if fmd5 in state.md5s:
+            result["duplicate"] += 1
+            return
+        if phash_threshold >= 0 and phash is not None:
+            if state.tree.search(hex_to_hash(phash), phash_threshold):
+                result["similar"] += 1
+                return
+            state.tree.add(hex_to_hash(phash), fmd5)
+
+        # 按内容寻址存储，其他词条已有同一张图片时直接引用
+        row = conn.execute('SELECT path FROM pictures WHERE md5=? LIMIT 1', (fmd5,)).fetchone()
+        relpath = row[0] if row else find_blob(store, fmd5)
+        if relpath is None:
+            relpath = blob_relpath(fmd5, extension)
+            if isinstance(source_data, str):
+                copy_to_blob(store, Path(source_data), relpath)
+            else:
+                write_blob(store, relpath, source_data)
+        state.md5s.add(fmd5)
+        state.added += 1
+        state.added_bytes += size
+        pending_rows.append((state.id, fmd5, relpath, size, phash))
+        result["added"] += 1
+        result["bytes"] += size
+        if len(pending_rows) >= batch_size:
+            flush()
+
+    workers = workers or os.cpu_count() or 1
+    # 按提交顺序处理结果，未完成的任务数有上限，压缩包中读出的内容不会全部堆在内存里
+    window: "deque[Tuple[str, Union[str, bytes], object]]" = deque()
+    processed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            def drain(limit: int):
+                nonlocal processed
+                while len(window) > limit:
+                    name, source_data, future = window.popleft()
+                    try:
+                        hashed = future.result()
+                    except Exception as e:
+                        print(f"{name}: 读取失败 {e}", file=sys.stderr)
+                        result["failed"] += 1
+                        continue
+                    store_item(name, source_data, hashed)
+                    processed += 1
+                    if processed % 1000 == 0:
+                        print(f"已处理{processed}张，新增{result['added']}张", file=sys.stderr)
+
+            for name, source_data in iter_source(source):
+                window.append((name, source_data, executor.submit(_hash_item, source_data, with_phash)))
+                drain(workers * 4)
+            drain(0)
+        flush()
+    finally:
+        conn.close()
+
+    result["keywords"] = sorted(keywords)
+    result["seconds"] = round(time.time() - started_at, 2)
+    return result
+
+
+def export_images(store: Path, dest: Path, keywords: Optional[List[str]] = None) -> Dict:
+    """把词条中的图片按 词条/md5.扩展名 的结构流式写入压缩包，返回统计结果"""
+    name = dest.name.lower()
+    if name.endswith(".zip"):
+        archive = zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        add = archive.write
+    elif name.endswith((".tar.gz", ".tgz")):
+        archive = tarfile.open(str(dest), mode="w|gz")
+        add = archive.add
+    elif name.endswith(".tar"):
+        archive = tarfile.open(str(dest), mode="w|")
+        add = archive.add
+    else:
+        raise ValueError("导出文件需以 .zip / .tar / .tar.gz / .tgz 结尾")
+
+    conn = sqlite3.connect(store / "data.db", timeout=30)
+    query = 'SELECT k.name, p.md5, p.path FROM pictures p JOIN keywords k ON k.id = p.keyword_id'
+    params: Tuple[str, ...] = ()
+    if keywords:
+        query += f' WHERE k.name IN ({", ".join("?" for _ in keywords)})'
+        params = tuple(keywords)
+    result = {"exported": 0, "missing": 0, "bytes": 0}
+    started_at = time.time()
+    try:
+        with archive:
+            for command, fmd5, relpath in conn.execute(query + ' ORDER BY k.id, p.id', params):
+                path = store / relpath
+                try:
+                    size = path.stat().st_size
+                except FileNotFoundError:
+                    print(f"{relpath}: 文件不存在，跳过", file=sys.stderr)
+                    result["missing"] += 1
+                    continue
+                add(str(path), f"{command}/{fmd5}{path.suffix.lower()}")
+                result["exported"] += 1
+                result["bytes"] += size
+    finally:
+        conn.close()
+    result["seconds"] = round(time.time() - started_at, 2)
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="randpic图库批量导入/导出")
+    parser.add_argument("--store", default="data/randpic", help="图片存储路径，与RANDPIC_STORE_DIR_PATH一致")
+    parser.add_argument("--json", action="store_true", help="以JSON输出统计结果")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    import_parser = subparsers.add_parser("import", help="导入目录或压缩包（.zip/.tar/.tar.gz）")
+    import_parser.add_argument("source")
+    import_parser.add_argument("-k", "--keyword", help="导入到的词条，不填则以第一级目录名作为词条")
+    import_parser.add_argument("--workers", type=int, help="计算哈希的进程数，默认为CPU核数")
+    import_parser.add_argument("--batch-size", type=int, default=500, help="每批提交的图片数")
+    import_parser.add_argument("--phash-threshold", type=int, default=-1,
+                               help="感知哈希近似去重阈值，小于0时只按md5去重")
+    import_parser.add_argument("--no-phash", action="store_true", help="不计算感知哈希")
+
+    export_parser = subparsers.add_parser("export", help="导出到压缩包（.zip/.tar/.tar.gz）")
+    export_parser.add_argument("dest")
+    export_parser.add_argument("-k", "--keyword", action="append", help="导出的词条，可重复，不填则导出全部")
+
+    args = parser.parse_args(argv)
+    store = Path(args.store)
+    if not (store / "data.db").exists():
+        parser.error(f"{store / 'data.db'}不存在，请先启动一次bot或检查--store")
+
+    try:
+        if args.action == "import":
+            result = import_images(store, Path(args.source), args.keyword, args.workers, args.batch_size,
+                                   not args.no_phash, args.phash_threshold)
+        else:
+            result = export_images(store, Path(args.dest), args.keyword)
+    except (ValueError, OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+        parser.error(str(e))
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        for key, value in result.items():
+            print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from typing import Optional
+
+
+class PayloadCache:
+    """按字节预算和条目数淘汰的LRU缓存，保存可直接发送的图片消息段内容"""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def get(self, key: str) -> Optional[str]:
+        """命中时把条目移到队尾，未命中返回None"""
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        """写入缓存，超过预算时从最久未使用的条目开始淘汰"""
+        size = len(value)
+        if not self.enabled or size > self.max_bytes:
+            return
+        self.invalidate(key)
+        self._data[key] = value
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes or len(self._data) > self.max_entries:
+            _, evicted = self._data.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, key: str):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self.current_bytes -= len(value)
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return (f"条目: {len(self._data)}/{self.max_entries}\n"
+                f"占用: {self.current_bytes / 1024 / 1024:.1f}MB/{self.max_bytes / 1024 / 1024:.1f}MB\n"
+                f"命中: {self.hits} 未命中: {self.misses} 命中率: {hit_rate:.1f}%\n"
+                f"淘汰: {self.evictions}")
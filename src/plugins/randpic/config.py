@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Extra
-from typing import List
+from typing import List, Optional
 from nonebot import require
 
 require("nonebot_plugin_localstore")
@@ -12,4 +12,33 @@ class Config(BaseModel, extra=Extra.ignore):
     randpic_store_dir_path: str = get_data_dir("randpic") # 用户自定义图片存储文件夹
     randpic_banner_group: List[int] = []  # 禁用群组列表
     randpic_limit_value: int = 5
-    randpic_limit_interval_seconds: int = 300
\ No newline at end of file
+    randpic_limit_interval_seconds: int = 300
+    randpic_group_limit_value: int = 0  # 每个群在限制间隔内的次数，0为不限制
+    randpic_group_limit_interval_seconds: int = 300
+    randpic_limit_max_entries: int = 10000  # 限流器在内存中保留的最大条目数
+    randpic_limit_persist: bool = True  # 把限流状态保存到数据库，重启后保留
+    randpic_send_mode: str = "base64"  # 图片发送方式：base64 / file（OneBot与bot共享文件系统）/ http（OneBot从bot的HTTP服务拉取）
+    randpic_file_path_prefix: Optional[str] = None  # file模式下OneBot端看到的存储目录，与bot端路径不同时填写（如docker挂载）
+    randpic_http_base_url: Optional[str] = None  # http模式下OneBot端可访问的bot地址，如 http://mikan-bot:8080
+    randpic_cache_max_bytes: int = 64 * 1024 * 1024  # base64消息缓存的字节上限，0为关闭缓存
+    randpic_cache_max_entries: int = 256  # base64消息缓存的条目上限
+    randpic_log_flush_rows: int = 50  # 使用日志缓冲达到该条数时写入数据库
+    randpic_log_flush_interval_ms: int = 2000  # 使用日志定时写入间隔（毫秒）
+    randpic_download_concurrency: int = 8  # 添加图片时的最大并发下载数
+    randpic_download_timeout: float = 5.0  # 单张图片下载超时（秒）
+    randpic_phash_threshold: int = 4  # 感知哈希判定近似重复的汉明距离阈值，小于0时关闭近似去重（需要Pillow）
+    randpic_transcode_enabled: bool = False  # 发送压缩后的派生图片（需要Pillow）
+    randpic_transcode_on_ingest: bool = False  # 添加图片时即生成派生图片，否则在首次发送时生成
+    randpic_transcode_min_bytes: int = 1024 * 1024  # 超过该大小的图片才转码
+    randpic_transcode_max_dimension: int = 1600  # 派生图片的最大边长
+    randpic_transcode_format: str = "JPEG"  # 静态图片的派生格式：JPEG / WEBP，GIF保持GIF
+    randpic_transcode_quality: int = 85  # 派生图片质量
+    randpic_transcode_gif_max_frames: int = 100  # GIF派生图片的最大帧数
+    randpic_reconcile_interval_hours: int = 24  # 核对数据库统计与磁盘文件的间隔（小时）
+    randpic_match_mode: str = "exact"  # 触发方式：exact（消息与词条/别名完全一致）/ prefix（消息以词条/别名开头）
+    randpic_trigger_max_length: int = 64  # 超过该长度的消息不参与匹配
+    randpic_select_state_max_entries: int = 10000  # 按群保存的选取状态（洗牌/最近发送）最多条目数，超过后淘汰最久未使用的
+    randpic_select_recent_size: int = 20  # recency模式下每个群避开的最近图片数量
+    randpic_prefetch_enabled: bool = True  # 发送后在后台预先选出并读取下一张图片
+    randpic_prefetch_max_entries: int = 1024  # 最多保留的预取条目数，超过后淘汰最久未使用的
+    randpic_io_workers: int = 4  # 文件读写、base64编码、哈希和转码线程池的线程数
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+
+class TokenBucketLimiter:
+    """令牌桶限流器：每个key一个桶，容量为capacity，每interval秒匀速补满
+
+    条目按最近使用排序，超过max_entries时淘汰最久未使用的条目，
+    已经补满的空闲条目与不存在等价，由prune清理。
+    """
+
+    def __init__(self, capacity: int, interval: float, max_entries: int):
+        self.capacity = capacity
+        self.interval = interval
+        self.max_entries = max_entries
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # key -> [剩余令牌, 更新时间]
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0 and self.interval > 0
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _tokens(self, key: str, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.capacity)
+        tokens, updated_at = bucket
+        return min(float(self.capacity), tokens + (now - updated_at) * self.rate)
+
+    def check(self, key, now: Optional[float] = None) -> bool:
+        """是否还有可用次数，不消耗令牌"""
+        if not self.enabled:
+            return True
+        return self._tokens(str(key), now or time.time()) >= 1
+
+    def consume(self, key, now: Optional[float] = None):
+        """消耗一次令牌"""
+        if not self.enabled:
+            return
+        key = str(key)
+        now = now or time.time()
+        self._buckets[key] = [max(0.0, self._tokens(key, now) - 1), now]
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+
+    def retry_after(self, key, now: Optional[float] = None) -> float:
+        """距离下一次可用还需等待的秒数"""
+        if not self.enabled:
+            return 0.0
+        tokens = self._tokens(str(key), now or time.time())
+        return max(0.0, (1 - tokens) / self.rate)
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """清理已经补满的空闲条目，返回清理数量"""
+        now = now or time.time()
+        full = [key for key in self._buckets if self._tokens(key, now) >= self.capacity]
+        for key in full:
+            del self._buckets[key]
+        return len(full)
+
+    def dump(self) -> List[Tuple[str, float, float]]:
+        return [(key, tokens, updated_at) for key, (tokens, updated_at) in self._buckets.items()]
+
+    def load(self, rows: Iterable[Tuple[str, float, float]]):
+        for key, tokens, updated_at in sorted(rows, key=lambda row: row[2]):
+            self._buckets[key] = [tokens, updated_at]
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
@@ -0,0 +1,86 @@
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow为可选依赖，未安装时不做近似去重
+    Image = None
+
+HASH_SIZE = 8
+
+
+def dhash(data: bytes) -> Optional[int]:
+    """计算64位差值哈希（dHash），Pillow未安装或无法解码时返回None"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # GIF等多帧图片只取第一帧
+            small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hash_to_hex(value: int) -> str:
+    return f"{value:016x}"
+
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """按汉明距离组织的BK树，查询时只访问可能落在阈值内的子树"""
+
+    def __init__(self):
+        # 节点: [哈希值, 该哈希对应的条目列表, {距离: 子节点}]
+        self._root: Optional[list] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value: int, item: Any):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            children: Dict[int, list] = node[2]
+            if distance not in children:
+                children[distance] = [value, [item], {}]
+                return
+            node = children[distance]
+
+    def search(self, value: int, threshold: int) -> List[Tuple[int, Any]]:
+        """返回与value汉明距离不超过threshold的(距离, 条目)列表"""
+        result: List[Tuple[int, Any]] = []
+        if self._root is None:
+            return result
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= threshold:
+                result.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    stack.append(child)
+        return result
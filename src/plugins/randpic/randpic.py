@@ -1,25 +1,39 @@
-from httpx import AsyncClient
-from nonebot.adapters.onebot.v11 import MessageSegment, Message, GroupMessageEvent
+from httpx import AsyncClient, Limits
+from nonebot.adapters.onebot.v11 import MessageSegment, Message, GroupMessageEvent, Event
 from nonebot.adapters.onebot.v11 import GROUP, GROUP_ADMIN, GROUP_OWNER, GROUP_MEMBER
 from nonebot.plugin import on_fullmatch, on_message, on_command, on_shell_command
 from nonebot.params import Arg, ArgStr, ShellCommandArgs, Fullmatch, Received, CommandArg, RawCommand, CommandStart
 from nonebot.typing import T_State
 from nonebot.matcher import Matcher
 from nonebot.rule import Namespace, ArgumentParser
-from nonebot import get_driver, require
+from nonebot import get_driver, get_app, require
 from nonebot.log import logger
-from pathlib import Path
-from typing import Tuple, List, Set
+from pathlib import Path, PurePosixPath
+from datetime import datetime, timezone, timedelta
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from typing import Tuple, List, Set, Dict, Optional, Type
 import asyncio
 import hashlib
 import aiosqlite
 import base64
+import json
 import os
+import re
+import sys
 
 require("nonebot_plugin_apscheduler")
 from nonebot_plugin_apscheduler import scheduler
 
 from .config import Config
+from .cache import PayloadCache
+from .storage import BLOB_DIR_NAME, guess_extension, blob_relpath, find_blob, write_blob, move_to_blob
+from .phash import Image, BKTree, dhash, hash_to_hex, hex_to_hash
+from .transcode import derivative_relpath, transcode
+from .trigger import TriggerTrie
+from .limiter import TokenBucketLimiter
+from .selector import SELECT_MODES, PicSelector
 
 __plugin_meta__ = {
     "name": "随机发送图片",
@@ -34,37 +48,182 @@ __plugin_meta__ = {
 # 全局变量
 config_dict = Config.parse_obj(get_driver().config.dict())
 randpic_path = Path(config_dict.randpic_store_dir_path)
-randpic_command_list: List[str] = [path for path in os.listdir(randpic_path) if os.path.isdir(randpic_path / path)]
+randpic_command_list: List[str] = [path for path in os.listdir(randpic_path)
+                                   if os.path.isdir(randpic_path / path) and path != BLOB_DIR_NAME]
 randpic_command_set: Set[str] = set(randpic_command_list)
 randpic_command_tuple: Tuple[str, ...] = tuple(randpic_command_set)
 randpic_command_add_tuple = tuple("添加" + tup for tup in randpic_command_tuple)
 randpic_command_path_tuple = tuple(randpic_path / command for command in randpic_command_tuple)
 randpic_banner_group = config_dict.randpic_banner_group
 randpic_alias_dict = {}
-per_user_limit = {}
-LIMIT = config_dict.randpic_limit_value
+randpic_trigger = TriggerTrie()  # 词条和别名的前缀树，启动后构建
+randpic_keyword_ids: Dict[str, int] = {}  # 词条 -> keywords表中的id
+randpic_pic_index: Dict[str, List[str]] = {}  # 词条 -> 图片路径数组，随机选取为O(1)
+randpic_phash_index: Dict[str, BKTree] = {}  # 词条 -> 感知哈希BK树，用于近似重复查询
+randpic_send_file_map: Dict[str, str] = {}  # 原图 -> 实际发送的文件（派生图片或原图）
+randpic_send_file_jobs: Dict[str, "asyncio.Future[str]"] = {}  # 正在转码的原图 -> 转码任务，同一张图片只转码一次
+randpic_select_modes: Dict[str, str] = {}  # 词条 -> 图片选取模式，未设置时为uniform
+pic_selector = PicSelector(config_dict.randpic_select_state_max_entries, config_dict.randpic_select_recent_size)
+# 预取的下一张图片：(词条, 群) -> (选取时的图片数组, 原图, 实际发送的文件)，数组被重建后作废
+randpic_prefetched: "OrderedDict[Tuple[str, int], Tuple[List[str], str, str]]" = OrderedDict()
+randpic_prefetch_tasks: Dict[Tuple[str, int], asyncio.Task] = {}
+user_limiter = TokenBucketLimiter(config_dict.randpic_limit_value, config_dict.randpic_limit_interval_seconds,
+                                  config_dict.randpic_limit_max_entries)
+group_limiter = TokenBucketLimiter(config_dict.randpic_group_limit_value,
+                                   config_dict.randpic_group_limit_interval_seconds,
+                                   config_dict.randpic_limit_max_entries)
+randpic_limiters = {"user": user_limiter, "group": group_limiter}
 hash_str = '3srzmcn0vqp_123'
-randpic_filename: str = 'randpic_{command}_{index}'
+randpic_limit_loaded = False  # 启动时读取限流状态后才允许写回，避免覆盖
+randpic_send_mode = config_dict.randpic_send_mode
+RANDPIC_HTTP_ROUTE = "/randpic/files"
+payload_cache = PayloadCache(config_dict.randpic_cache_max_bytes, config_dict.randpic_cache_max_entries)
+randpic_log_buffer: List[Tuple[str, str, int, int]] = []  # 待写入的使用日志 (command, time, caller_id, group_id)
+randpic_log_tasks: Set[asyncio.Task] = set()
+randpic_write_lock: asyncio.Lock  # 共享连接上的写事务互斥，避免提交或回滚其他协程未完成的写入，在启动时创建
+# 文件读写、base64编码、哈希和转码都在这个线程池中执行，不阻塞事件循环
+io_executor = ThreadPoolExecutor(max_workers=config_dict.randpic_io_workers, thread_name_prefix="randpic-io")
+randpic_resolved_path = randpic_path.resolve()
+http_client = AsyncClient(
+    timeout=config_dict.randpic_download_timeout,
+    limits=Limits(max_connections=config_dict.randpic_download_concurrency,
+                  max_keepalive_connections=config_dict.randpic_download_concurrency),
+)
 connection: aiosqlite.Connection
 
-# 定时任务：刷新用户限制
-@scheduler.scheduled_job("interval", seconds=config_dict.randpic_limit_interval_seconds, id="refresh_per_user_limit")
-async def refresh_per_user_limit():
-    logger.info("Refresh per-user limit")
-    for id in per_user_limit:
-        per_user_limit[id] = LIMIT
+# 定时任务：清理空闲的限流条目并保存限流状态
+@scheduler.scheduled_job("interval", seconds=60, id="prune_rate_limits")
+async def prune_rate_limits():
+    pruned = sum(limiter.prune() for limiter in randpic_limiters.values())
+    if pruned:
+        logger.debug(f"Pruned {pruned} idle rate limit entries")
+    await save_rate_limits()
+
+async def save_rate_limits():
+    """把限流状态写入数据库"""
+    if not config_dict.randpic_limit_persist or not randpic_limit_loaded:
+        return
+    rows = [(scope, key, tokens, updated_at)
+            for scope, limiter in randpic_limiters.items()
+            for key, tokens, updated_at in limiter.dump()]
+    async with randpic_write_lock:
+        try:
+            await connection.execute('DELETE FROM randpic_rate_limit')
+            await connection.executemany(
+                'INSERT INTO randpic_rate_limit (scope, key, tokens, updated_at) VALUES (?, ?, ?, ?)', rows)
+            await connection.commit()
+        except Exception as e:
+            logger.warning(f"保存限流状态失败: {e}")
+            await connection.rollback()
+
+# 定时任务：写入使用日志
+@scheduler.scheduled_job("interval", seconds=config_dict.randpic_log_flush_interval_ms / 1000, id="flush_randpic_log")
+async def flush_randpic_log():
+    """把缓冲的使用日志在一个事务中写入数据库"""
+    global randpic_log_buffer
+    if not randpic_log_buffer:
+        return
+    rows, randpic_log_buffer = randpic_log_buffer, []
+
+    # 同一事务内增量更新小时/天汇总表
+    hourly = Counter((time[:13] + ":00:00", str(group_id), command, str(caller_id))
+                     for command, time, caller_id, group_id in rows)
+    daily = Counter((time[:10], str(group_id), command, str(caller_id))
+                    for command, time, caller_id, group_id in rows)
+
+    async with randpic_write_lock:
+        try:
+            await connection.executemany(
+                "INSERT INTO randpic_log (command, time, caller_id, group_id) VALUES (?, ?, ?, ?)", rows)
+            for table, counter in (("randpic_stats_hourly", hourly), ("randpic_stats_daily", daily)):
+                await connection.executemany(f'''
+                    INSERT INTO {table} (bucket, group_id, command, caller_id, count) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(group_id, bucket, command, caller_id) DO UPDATE SET count = count + excluded.count
+                ''', [key + (count,) for key, count in counter.items()])
+            await connection.commit()
+        except Exception as e:
+            logger.warning(f"写入使用日志失败: {e}")
+            await connection.rollback()
+            # 放回缓冲区等待下次写入
+            randpic_log_buffer = rows + randpic_log_buffer
+
+async def backfill_randpic_stats():
+    """根据完整的使用日志重建小时/天汇总表"""
+    async with randpic_write_lock:
+        await connection.execute("DELETE FROM randpic_stats_hourly")
+        await connection.execute("DELETE FROM randpic_stats_daily")
+        await connection.execute('''
+            INSERT INTO randpic_stats_hourly (bucket, group_id, command, caller_id, count)
+            SELECT strftime('%Y-%m-%d %H:00:00', time), group_id, command, caller_id, COUNT(*)
+            FROM randpic_log GROUP BY 1, 2, 3, 4
+        ''')
+        await connection.execute('''
+            INSERT INTO randpic_stats_daily (bucket, group_id, command, caller_id, count)
+            SELECT date(time), group_id, command, caller_id, COUNT(*)
+            FROM randpic_log GROUP BY 1, 2, 3, 4
+        ''')
+        await connection.commit()
 
 # 驱动器
 driver = get_driver()
 
+def register_file_route():
+    """在FastAPI驱动上注册图片文件路由，供http发送方式使用"""
+    from fastapi import HTTPException
+    from fastapi.responses import FileResponse
+
+    app = get_app()
+    root = randpic_resolved_path
+
+    # 同步函数由FastAPI放到线程池中执行，路径解析和文件检查不阻塞事件循环
+    @app.get(RANDPIC_HTTP_ROUTE + "/{file_path:path}")
+    def _(file_path: str):
+        parts = PurePosixPath(file_path).parts
+        # 只允许访问图片存储目录和词条目录下的文件，避免暴露数据库等其他文件
+        if len(parts) < 2 or (parts[0] != BLOB_DIR_NAME and parts[0] not in randpic_command_set):
+            raise HTTPException(status_code=404)
+        img = (root / file_path).resolve()
+        if not img.is_relative_to(root) or not img.is_file():
+            raise HTTPException(status_code=404)
+        return FileResponse(img)
+
+if randpic_send_mode == "http":
+    try:
+        if not config_dict.randpic_http_base_url:
+            raise ValueError("未配置randpic_http_base_url")
+        register_file_route()
+    except Exception as e:
+        logger.warning(f"http发送方式不可用，回退到base64: {e}")
+        randpic_send_mode = "base64"
+elif randpic_send_mode not in ("base64", "file"):
+    logger.warning(f"未知的发送方式{randpic_send_mode}，回退到base64")
+    randpic_send_mode = "base64"
+
 @driver.on_startup
 async def _():
     logger.info("正在检查文件...")
     await asyncio.create_task(create_file())
     logger.info("文件检查完成，欢迎使用插件！")
 
+@driver.on_shutdown
+async def _():
+    for task in list(randpic_prefetch_tasks.values()):
+        task.cancel()
+    await flush_randpic_log()
+    await save_rate_limits()
+    await connection.close()
+    await http_client.aclose()
+    io_executor.shutdown(wait=False, cancel_futures=True)
+
+async def run_io(func, *args):
+    """在文件I/O线程池中执行阻塞操作"""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
 async def create_file():
     """创建所需文件夹和数据库"""
+    global randpic_write_lock
+    randpic_write_lock = asyncio.Lock()
+
     # 创建文件夹
     for path in randpic_command_path_tuple:
         if not path.exists():
@@ -83,7 +242,61 @@ async def create_file():
             value TEXT
         )
     ''')
+
+    # 创建使用日志表
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS randpic_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT,
+            time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            caller_id TEXT,
+            group_id TEXT
+        )
+    ''')
+
+    # 创建使用统计汇总表
+    for table in ("randpic_stats_hourly", "randpic_stats_daily"):
+        await cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT,
+                group_id TEXT,
+                command TEXT,
+                caller_id TEXT,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (group_id, bucket, command, caller_id)
+            )
+        ''')
+        await cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_caller ON {table} (caller_id, bucket)')
+    # 统计查询的起止时间不在整点时，零散部分从原始日志中按时间范围统计
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_randpic_log_time ON randpic_log (time)')
+    await connection.commit()
+
+    # 已有日志但汇总表为空时回填
+    await cursor.execute('SELECT EXISTS(SELECT 1 FROM randpic_stats_daily), EXISTS(SELECT 1 FROM randpic_log)')
+    has_stats, has_log = await cursor.fetchone()
+    if has_log and not has_stats:
+        logger.info("正在回填使用统计...")
+        await backfill_randpic_stats()
+
+    # 创建并读取限流状态表
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS randpic_rate_limit (
+            scope TEXT,
+            key TEXT,
+            tokens REAL,
+            updated_at REAL,
+            PRIMARY KEY (scope, key)
+        )
+    ''')
     await connection.commit()
+    if config_dict.randpic_limit_persist:
+        await cursor.execute('SELECT scope, key, tokens, updated_at FROM randpic_rate_limit')
+        rows = await cursor.fetchall()
+        for scope, limiter in randpic_limiters.items():
+            limiter.load((key, tokens, updated_at) for row_scope, key, tokens, updated_at in rows
+                         if row_scope == scope)
+    global randpic_limit_loaded
+    randpic_limit_loaded = True
 
     # 读取别名表
     try:
@@ -95,103 +308,485 @@ async def create_file():
         logger.warning(f"读取别名表失败: {e}")
         randpic_alias_dict = {}
 
-async def create_command(command):
-    """创建新的命令文件夹和数据库表"""
-    path = randpic_path / command
-    if path.exists():
-        return
-    path.mkdir(parents=True, exist_ok=True)
+    # 创建词条表和图片表
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS keywords (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            pic_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            select_mode TEXT NOT NULL DEFAULT 'uniform'
+        )
+    ''')
+    await cursor.execute('PRAGMA table_info(keywords)')
+    keyword_columns = [row[1] for row in await cursor.fetchall()]
+    need_recount = "pic_count" not in keyword_columns
+    if need_recount:
+        await cursor.execute('ALTER TABLE keywords ADD COLUMN pic_count INTEGER NOT NULL DEFAULT 0')
+        await cursor.execute('ALTER TABLE keywords ADD COLUMN total_bytes INTEGER NOT NULL DEFAULT 0')
+    if "select_mode" not in keyword_columns:
+        await cursor.execute("ALTER TABLE keywords ADD COLUMN select_mode TEXT NOT NULL DEFAULT 'uniform'")
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pictures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            keyword_id INTEGER NOT NULL REFERENCES keywords (id),
+            md5 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            phash TEXT,
+            added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (keyword_id, md5)
+        )
+    ''')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_md5 ON pictures (md5)')
+    await cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_path ON pictures (path)')
+    for command in randpic_command_list:
+        await cursor.execute('INSERT OR IGNORE INTO keywords (name) VALUES (?)', (command,))
+    await connection.commit()
 
-    randpic_command_list.append(command)
-    randpic_command_set.add(command)
+    if await migrate_legacy_tables() or need_recount:
+        await recount_keywords()
+
+    await load_keywords()
+
+    if Image is None and config_dict.randpic_phash_threshold >= 0:
+        logger.warning("未安装Pillow，近似重复检测不可用")
 
+    # 加载图片索引
+    await rebuild_pic_index()
+    rebuild_trigger()
+
+async def load_keywords():
+    """读取词条id和选取模式，数据库中存在但缺少文件夹的词条也一并注册"""
+    global connection
+    cursor = await connection.execute('SELECT id, name, select_mode FROM keywords')
+    for keyword_id, name, select_mode in await cursor.fetchall():
+        randpic_keyword_ids[name] = keyword_id
+        if select_mode in SELECT_MODES and select_mode != "uniform":
+            randpic_select_modes[name] = select_mode
+        if name not in randpic_command_set:
+            (randpic_path / name).mkdir(parents=True, exist_ok=True)
+            register_command(name)
+    await cursor.close()
+
+async def migrate_legacy_tables() -> bool:
+    """把旧版本每个词条一张的Pic_of_*表迁移到pictures表，返回是否发生了迁移"""
     global connection
     cursor = await connection.cursor()
+    await cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Pic\\_of\\_%' ESCAPE '\\'")
+    tables = [row[0] for row in await cursor.fetchall()]
 
-    # 创建表
-    await cursor.execute(f'DROP table if exists Pic_of_{command};')
-    await cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS Pic_of_{command} (
-            md5 TEXT PRIMARY KEY,
-            img_url TEXT
-        )
+    for table in tables:
+        command = table[len("Pic_of_"):]
+        logger.info(f"正在迁移{table}...")
+        await cursor.execute(f'PRAGMA table_info("{table}")')
+        columns = [row[1] for row in await cursor.fetchall()]
+        phash_column = "phash" if "phash" in columns else "NULL"
+
+        await cursor.execute('INSERT OR IGNORE INTO keywords (name) VALUES (?)', (command,))
+        await cursor.execute('SELECT id FROM keywords WHERE name=?', (command,))
+        keyword_id = (await cursor.fetchone())[0]
+        await cursor.execute(f'''
+            INSERT OR IGNORE INTO pictures (keyword_id, md5, path, phash)
+            SELECT ?, md5, img_url, {phash_column} FROM "{table}"
+        ''', (keyword_id,))
+        await cursor.execute(f'DROP TABLE "{table}"')
+        await connection.commit()
+
+    # 补全迁移数据的文件大小
+    if tables:
+        await cursor.execute('SELECT id, path FROM pictures WHERE size IS NULL')
+        rows = await cursor.fetchall()
+
+        def stat_sizes() -> List[Tuple[int, int]]:
+            sizes = []
+            for picture_id, path in rows:
+                try:
+                    sizes.append(((randpic_path / Path(path)).stat().st_size, picture_id))
+                except OSError:
+                    continue
+            return sizes
+
+        sizes = await run_io(stat_sizes)
+        await cursor.executemany('UPDATE pictures SET size=? WHERE id=?', sizes)
+        await connection.commit()
+    await cursor.close()
+    return bool(tables)
+
+async def recount_keywords():
+    """根据pictures表重新计算各词条的图片数量和总大小"""
+    async with randpic_write_lock:
+        await connection.execute('''
+            UPDATE keywords SET
+                pic_count = (SELECT COUNT(*) FROM pictures WHERE keyword_id = keywords.id),
+                total_bytes = (SELECT COALESCE(SUM(size), 0) FROM pictures WHERE keyword_id = keywords.id)
         ''')
-    await connection.commit()
-    
-    # 更新全局变量
-    global randpic_command_tuple, randpic_command_path_tuple
-    randpic_command_tuple = tuple(randpic_command_set)
-    randpic_command_path_tuple = tuple(randpic_path / cmd for cmd in randpic_command_tuple)
+        await connection.commit()
 
-async def randpic_log(command, caller_id, group_id):
-    """记录随机图片使用日志"""
-    global connection
+def stat_pictures(rows: List[Tuple[str, Optional[int]]]) -> Tuple[List[str], List[Tuple[int, str]]]:
+    """检查图片文件，返回(缺失文件, [(磁盘大小, 大小不一致的文件)])"""
+    missing: List[str] = []
+    mismatched: List[Tuple[int, str]] = []
+    for path, size in rows:
+        try:
+            disk_size = (randpic_path / Path(path)).stat().st_size
+        except OSError:
+            missing.append(path)
+            continue
+        if disk_size != size:
+            mismatched.append((disk_size, path))
+    return missing, mismatched
+
+# 派生文件名形如 <原图文件名>.d<边长>q<质量>.<扩展名>
+DERIVATIVE_NAME = re.compile(r"^(.+)\.d\d+q\d+\.[^.]+$")
+
+def find_unreferenced(paths: List[str]) -> List[Tuple[str, int]]:
+    """遍历内容寻址存储和各词条目录，返回没有数据库记录引用的文件 [(相对路径, 大小)]
+
+    原图仍被引用的派生文件视为已引用；失败的写入留下的临时文件也会被报告。
+    """
+    referenced = set(paths)
+    referenced_stems = {(str(PurePosixPath(path).parent), PurePosixPath(path).stem) for path in paths}
+    roots = [randpic_path / BLOB_DIR_NAME] + [randpic_path / command for command in randpic_command_list]
+    unreferenced: List[Tuple[str, int]] = []
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                full_path = Path(dirpath) / name
+                relpath = full_path.relative_to(randpic_path).as_posix()
+                if relpath in referenced:
+                    continue
+                match = DERIVATIVE_NAME.match(name)
+                if match and (str(PurePosixPath(relpath).parent), match.group(1)) in referenced_stems:
+                    continue
+                try:
+                    unreferenced.append((relpath, full_path.stat().st_size))
+                except OSError:
+                    continue
+    return unreferenced
+
+# 定时任务：核对数据库统计与磁盘文件
+@scheduler.scheduled_job("interval", hours=config_dict.randpic_reconcile_interval_hours, id="reconcile_randpic_storage")
+async def reconcile_storage() -> List[str]:
+    """核对词条统计、数据库记录与磁盘文件，修正统计并返回发现的差异"""
     cursor = await connection.cursor()
+    report: List[str] = []
+
+    # 文件缺失只报告，大小不一致时以磁盘为准
+    await cursor.execute('SELECT DISTINCT path, size FROM pictures')
+    rows = await cursor.fetchall()
+    missing, mismatched = await run_io(stat_pictures, rows)
+    if missing:
+        report.append(f"缺失文件{len(missing)}个: " + ", ".join(missing[:5]) + (" ..." if len(missing) > 5 else ""))
+    if mismatched:
+        report.append(f"大小不一致{len(mismatched)}个，已按磁盘修正")
+        async with randpic_write_lock:
+            await connection.executemany('UPDATE pictures SET size=? WHERE path=?', mismatched)
+            await connection.commit()
+
+    # 磁盘上没有记录引用的文件只报告，不自动删除
+    unreferenced = await run_io(find_unreferenced, [path for path, _ in rows])
+    if unreferenced:
+        unreferenced_bytes = sum(size for _, size in unreferenced)
+        report.append(f"未引用的文件{len(unreferenced)}个，共{unreferenced_bytes / 1024 / 1024:.1f}MB: "
+                      + ", ".join(path for path, _ in unreferenced[:5]) + (" ..." if len(unreferenced) > 5 else ""))
 
     await cursor.execute('''
-            CREATE TABLE IF NOT EXISTS randpic_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            command TEXT,
-            time DATETIME DEFAULT CURRENT_TIMESTAMP,
-            caller_id TEXT,
-            group_id TEXT
-        );
-        ''')
+        SELECT k.name, k.pic_count, k.total_bytes, COUNT(p.id), COALESCE(SUM(p.size), 0)
+        FROM keywords k LEFT JOIN pictures p ON p.keyword_id = k.id
+        GROUP BY k.id
+    ''')
+    for name, pic_count, total_bytes, actual_count, actual_bytes in await cursor.fetchall():
+        if (pic_count, total_bytes) != (actual_count, actual_bytes):
+            report.append(f"{name}统计偏差: {pic_count}张/{total_bytes}B -> {actual_count}张/{actual_bytes}B")
+    await cursor.close()
+    await recount_keywords()
 
-    await cursor.execute("INSERT INTO randpic_log (command, caller_id, group_id) VALUES (?, ?, ?)", 
-                        (command, caller_id, group_id))
-    await connection.commit()
+    if report:
+        logger.warning("存储核对发现差异:\n" + "\n".join(report))
+    else:
+        logger.info("存储核对完成，未发现差异")
+    return report
 
-# 消息处理器
-msg = on_message(priority=5, block=False)
+async def rebuild_pic_index(command: Optional[str] = None):
+    """从数据库重建图片索引，command为空时重建全部词条"""
+    global connection
+    cursor = await connection.cursor()
+    commands = [command] if command else list(randpic_command_list)
+    for cmd in commands:
+        randpic_pic_index[cmd] = []
+        randpic_phash_index[cmd] = BKTree()
+    # 图片下标可能变化，清空选取状态
+    pic_selector.reset(command)
 
-@msg.handle()
-async def msg_handle(event: GroupMessageEvent):
-    """处理随机图片请求"""
-    if event.group_id in randpic_banner_group:
-        return
-    
-    arg = str(event.get_message()).strip()
-    if arg in randpic_command_set:
-        command = arg
-    elif arg in randpic_alias_dict:
-        command = randpic_alias_dict[arg]
+    query = '''
+        SELECT k.name, p.path, p.phash FROM pictures p
+        JOIN keywords k ON k.id = p.keyword_id
+    '''
+    if command:
+        await cursor.execute(query + ' WHERE k.name=? ORDER BY p.id', (command,))
     else:
-        return
+        await cursor.execute(query + ' ORDER BY p.id')
+    for name, path, phash in await cursor.fetchall():
+        if name not in randpic_pic_index:
+            continue
+        randpic_pic_index[name].append(path)
+        if phash:
+            randpic_phash_index[name].add(hex_to_hash(phash), path)
+    await cursor.close()
 
-    # 检查用户限制
-    if not event.user_id in per_user_limit:
-        per_user_limit[event.user_id] = LIMIT
+def register_command(command: str):
+    """在内存中注册词条"""
+    randpic_command_list.append(command)
+    randpic_command_set.add(command)
+    randpic_pic_index[command] = []
+    randpic_phash_index[command] = BKTree()
 
-    if per_user_limit[event.user_id] <= 0:
-        logger.info(f"{event.user_id} count less equal zero")
-        await msg.finish("次数超限，请稍后")
+    # 更新全局变量
+    global randpic_command_tuple, randpic_command_path_tuple
+    randpic_command_tuple = tuple(randpic_command_set)
+    randpic_command_path_tuple = tuple(randpic_path / cmd for cmd in randpic_command_tuple)
+    rebuild_trigger()
 
-    await randpic_log(command, event.user_id, event.group_id)
+def rebuild_trigger():
+    """词条或别名变更后重建触发前缀树"""
+    global randpic_trigger
+    randpic_trigger = TriggerTrie.build(randpic_command_list, randpic_alias_dict)
+
+async def create_command(command):
+    """创建新的命令文件夹和词条记录"""
+    path = randpic_path / command
+    if await run_io(path.exists):
+        return
+    await run_io(lambda: path.mkdir(parents=True, exist_ok=True))
+    register_command(command)
 
-    # 获取随机图片
     global connection
-    cursor = await connection.cursor()
-    await cursor.execute(f'SELECT img_url FROM Pic_of_{command} ORDER BY RANDOM() limit 1')
-    data = await cursor.fetchone()
-    if data is None:
-        await msg.finish('当前还没有图片!')
-    
-    file_name = data[0]
+    async with randpic_write_lock:
+        cursor = await connection.cursor()
+        await cursor.execute('INSERT OR IGNORE INTO keywords (name) VALUES (?)', (command,))
+        await cursor.execute('SELECT id FROM keywords WHERE name=?', (command,))
+        randpic_keyword_ids[command] = (await cursor.fetchone())[0]
+        await connection.commit()
+    await rebuild_pic_index(command)
+
+async def randpic_log(command, caller_id, group_id):
+    """记录随机图片使用日志，先写入内存缓冲，由flush_randpic_log批量落盘"""
+    # 与CURRENT_TIMESTAMP一致使用UTC时间
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    randpic_log_buffer.append((command, now, caller_id, group_id))
+
+    if len(randpic_log_buffer) >= config_dict.randpic_log_flush_rows:
+        task = asyncio.create_task(flush_randpic_log())
+        randpic_log_tasks.add(task)
+        task.add_done_callback(randpic_log_tasks.discard)
+
+def prepare_send_file(file_name: str) -> str:
+    """返回实际发送的文件，大图按配置生成压缩后的派生图片"""
+    send_file = randpic_send_file_map.get(file_name)
+    if send_file is not None:
+        return send_file
+
+    send_file = file_name
+    derived = derivative_relpath(file_name, config_dict.randpic_transcode_format,
+                                 config_dict.randpic_transcode_max_dimension,
+                                 config_dict.randpic_transcode_quality)
+    src = randpic_path / Path(file_name)
+    dest = randpic_path / Path(derived)
+    try:
+        if dest.exists():
+            send_file = derived
+        elif src.stat().st_size >= config_dict.randpic_transcode_min_bytes:
+            if transcode(src, dest, config_dict.randpic_transcode_format,
+                         config_dict.randpic_transcode_max_dimension,
+                         config_dict.randpic_transcode_quality,
+                         config_dict.randpic_transcode_gif_max_frames):
+                send_file = derived
+    except Exception as e:
+        # 转码出错时不缓存回退结果，下次再试；派生文件已由其他进程生成时直接使用
+        logger.warning(f"{file_name}转码失败: {e}")
+        if not dest.exists():
+            return file_name
+        send_file = derived
+    randpic_send_file_map[file_name] = send_file
+    return send_file
+
+async def resolve_send_file(file_name: str) -> str:
+    """未启用转码时直接返回原图，否则在线程池中准备派生图片"""
+    if not config_dict.randpic_transcode_enabled or Image is None:
+        return file_name
+    if file_name in randpic_send_file_map:
+        return randpic_send_file_map[file_name]
+    # 同一张图片正在转码时等待同一个任务
+    job = randpic_send_file_jobs.get(file_name)
+    if job is None:
+        job = asyncio.ensure_future(run_io(prepare_send_file, file_name))
+        randpic_send_file_jobs[file_name] = job
+        job.add_done_callback(lambda _: randpic_send_file_jobs.pop(file_name, None))
+    return await asyncio.shield(job)
+
+def encode_image(file_name: str) -> str:
+    """读取图片并编码为base64消息，在线程池中执行"""
     # 使用pathlib处理路径，确保跨平台兼容性
     img = randpic_path / Path(file_name)
     with open(img, "rb") as f:
         file_content = f.read()
         encoded_content = base64.b64encode(file_content)
         b64_string = encoded_content.decode('utf-8')
+    return "base64://" + b64_string
+
+async def get_image_file(file_name: str, mode: str) -> str:
+    """根据发送方式生成图片消息段的file字段"""
+    if mode == "file":
+        if config_dict.randpic_file_path_prefix:
+            return (PurePosixPath(config_dict.randpic_file_path_prefix) / file_name).as_uri()
+        return (randpic_resolved_path / Path(file_name)).as_uri()
+    if mode == "http":
+        base_url = config_dict.randpic_http_base_url.rstrip("/")
+        return f"{base_url}{RANDPIC_HTTP_ROUTE}/{quote(file_name)}"
+
+    payload = payload_cache.get(file_name)
+    if payload is not None:
+        return payload
+    payload = await run_io(encode_image, file_name)
+    payload_cache.put(file_name, payload)
+    return payload
+
+async def send_image(matcher: Type[Matcher], file_name: str):
+    """按配置的发送方式发送图片，失败时回退到base64"""
+    if randpic_send_mode != "base64":
+        try:
+            await matcher.send(MessageSegment.image(await get_image_file(file_name, randpic_send_mode)))
+            return
+        except Exception as e:
+            logger.warning(f"{randpic_send_mode}方式发送失败，回退到base64: {e}")
+    await matcher.send(MessageSegment.image(await get_image_file(file_name, "base64")))
+
+def prefetch_key(command: str, group_id: int) -> Tuple[str, int]:
+    """按群区分的选取模式每个群单独预取，其他模式各群共用"""
+    if randpic_select_modes.get(command) in ("shuffle", "recency"):
+        return command, group_id
+    return command, 0
+
+def read_through(file_name: str):
+    """完整读取一遍文件以预热系统页缓存"""
+    with open(randpic_path / Path(file_name), "rb") as f:
+        while f.read(1 << 20):
+            pass
+
+async def warm_image(file_name: str):
+    """base64方式下把编码结果放入消息缓存，其他方式预热系统页缓存"""
+    if randpic_send_mode == "base64" and payload_cache.enabled:
+        await get_image_file(file_name, "base64")
+    else:
+        await run_io(read_through, file_name)
+
+async def prefetch_next(command: str, group_id: int):
+    """预先选出下一张图片，准备派生文件并读入内存"""
+    pics = randpic_pic_index.get(command)
+    if not pics:
+        return
+    key = prefetch_key(command, group_id)
+    mode = randpic_select_modes.get(command, "uniform")
+    file_name = pics[pic_selector.pick(mode, command, group_id, len(pics))]
+    send_file = await resolve_send_file(file_name)
+    try:
+        await warm_image(send_file)
+    except Exception as e:
+        logger.debug(f"预取{send_file}失败: {e}")
+    randpic_prefetched[key] = (pics, file_name, send_file)
+    randpic_prefetched.move_to_end(key)
+    while len(randpic_prefetched) > config_dict.randpic_prefetch_max_entries:
+        randpic_prefetched.popitem(last=False)
+
+def schedule_prefetch(command: str, group_id: int):
+    """在后台预取，同一个键同时只有一个预取任务"""
+    if not config_dict.randpic_prefetch_enabled:
+        return
+    key = prefetch_key(command, group_id)
+    if key in randpic_prefetch_tasks or key in randpic_prefetched:
+        return
+    task = asyncio.create_task(prefetch_next(command, group_id))
+    randpic_prefetch_tasks[key] = task
+    task.add_done_callback(lambda _: randpic_prefetch_tasks.pop(key, None))
+
+async def take_prefetched(command: str, group_id: int, pics: List[str]) -> Optional[str]:
+    """取出预取的图片，预取尚未完成时等待其完成"""
+    key = prefetch_key(command, group_id)
+    task = randpic_prefetch_tasks.get(key)
+    if task is not None:
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            logger.debug(f"预取{command}失败: {e}")
+    prefetched = randpic_prefetched.pop(key, None)
+    if prefetched is None or prefetched[0] is not pics:
+        return None
+    return prefetched[2]
+
+def drop_prefetched(command: str):
+    """选取模式变化后丢弃该词条已预取的图片"""
+    for key in [key for key in randpic_prefetched if key[0] == command]:
+        del randpic_prefetched[key]
+
+async def randpic_trigger_rule(event: Event, state: T_State) -> bool:
+    """判断消息是否触发随机图片，非纯文本或过长的消息在序列化前直接跳过"""
+    if not isinstance(event, GroupMessageEvent) or event.group_id in randpic_banner_group:
+        return False
+    message = event.get_message()
+    if len(message) != 1 or message[0].type != "text":
+        return False
+    text = message[0].data["text"]
+    if len(text) > config_dict.randpic_trigger_max_length:
+        return False
+
+    text = text.strip()
+    if config_dict.randpic_match_mode == "prefix":
+        matched = randpic_trigger.match_prefix(text)
+        command = matched[1] if matched else None
+    else:
+        command = randpic_trigger.match(text)
+    if command is None:
+        return False
+    state["randpic_command"] = command
+    return True
+
+# 消息处理器
+msg = on_message(rule=randpic_trigger_rule, priority=5, block=False)
+
+@msg.handle()
+async def msg_handle(event: GroupMessageEvent, state: T_State):
+    """处理随机图片请求"""
+    command = state["randpic_command"]
+
+    # 检查用户和群限制
+    if not user_limiter.check(event.user_id):
+        logger.info(f"{event.user_id} rate limited")
+        await msg.finish(f"次数超限，请{int(user_limiter.retry_after(event.user_id)) + 1}秒后再试")
+    if not group_limiter.check(event.group_id):
+        logger.info(f"group {event.group_id} rate limited")
+        await msg.finish(f"本群次数超限，请{int(group_limiter.retry_after(event.group_id)) + 1}秒后再试")
+
+    await randpic_log(command, event.user_id, event.group_id)
+
+    # 获取随机图片
+    pics = randpic_pic_index.get(command)
+    if not pics:
+        await msg.finish('当前还没有图片!')
     
-    b64_string = "base64://" + b64_string
+    file_name = await take_prefetched(command, event.group_id, pics)
+    if file_name is None:
+        mode = randpic_select_modes.get(command, "uniform")
+        index = pic_selector.pick(mode, command, event.group_id, len(pics))
+        file_name = await resolve_send_file(pics[index])
     try:
-        await msg.send(MessageSegment.image(b64_string))
-        per_user_limit[event.user_id] -= 1
+        await send_image(msg, file_name)
+        user_limiter.consume(event.user_id)
+        group_limiter.consume(event.group_id)
     except Exception as e:
         logger.info(e)
         await msg.send(f'{command}出不来了，稍后再试试吧~')
+    schedule_prefetch(command, event.group_id)
 
 # 添加别名命令
 add_alias = on_command("添加alias")
@@ -216,11 +811,13 @@ async def add_alias_handler(args: Message = CommandArg()):
         return
     
     global connection
-    cursor = await connection.cursor()
-    await cursor.execute(f"INSERT INTO Alias (key, value) VALUES (?, ?)", (alias, command))
-    await connection.commit()
+    async with randpic_write_lock:
+        cursor = await connection.cursor()
+        await cursor.execute(f"INSERT INTO Alias (key, value) VALUES (?, ?)", (alias, command))
+        await connection.commit()
 
     randpic_alias_dict[alias] = command
+    rebuild_trigger()
     await add_alias.send(f'Alias("{alias}"->"{command}")添加成功')
 
 # 删除别名命令
@@ -240,11 +837,13 @@ async def remove_alias_handler(event: GroupMessageEvent, args: Message = Command
         return
     
     global connection
-    cursor = await connection.cursor()
-    await cursor.execute(f"DELETE FROM Alias WHERE key='{alias}'")
-    await connection.commit()
+    async with randpic_write_lock:
+        cursor = await connection.cursor()
+        await cursor.execute(f"DELETE FROM Alias WHERE key='{alias}'")
+        await connection.commit()
 
     randpic_alias_dict.pop(alias)
+    rebuild_trigger()
     await remove_alias.send(f"{alias}删除成功")
 
 # 添加词条命令
@@ -258,9 +857,303 @@ async def add_keyword_handler(event: GroupMessageEvent, args: Message = CommandA
         return
     
     command = str(args)
+    if command == BLOB_DIR_NAME:
+        await add_keyword.finish(f'"{command}"为保留名称')
+        return
     await create_command(command)
     await add_keyword.send(f"{command}添加成功")
 
+# 设置选取模式命令
+set_select_mode = on_command("设置模式", aliases={"select_mode"})
+
+@set_select_mode.handle()
+async def set_select_mode_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """设置词条的图片选取模式"""
+    if event.user_id != 540729251:
+        await set_select_mode.finish("无权限执行")
+        return
+
+    modes_text = "\n".join(f"{mode}: {desc}" for mode, desc in SELECT_MODES.items())
+    args = str(args).split()
+    if len(args) == 1 and args[0] in randpic_command_set:
+        mode = randpic_select_modes.get(args[0], "uniform")
+        await set_select_mode.finish(f"{args[0]}当前模式: {mode}\n可选模式:\n{modes_text}")
+        return
+    if len(args) != 2:
+        await set_select_mode.finish(f"输入格式有误: /设置模式 <词条> <模式>\n可选模式:\n{modes_text}")
+        return
+
+    command, mode = args
+    if not command in randpic_command_set:
+        await set_select_mode.finish(f'"{command}"不是合法词条')
+        return
+    if mode not in SELECT_MODES:
+        await set_select_mode.finish(f'"{mode}"不是合法模式\n可选模式:\n{modes_text}')
+        return
+
+    global connection
+    async with randpic_write_lock:
+        await connection.execute('UPDATE keywords SET select_mode=? WHERE name=?', (mode, command))
+        await connection.commit()
+
+    if mode == "uniform":
+        randpic_select_modes.pop(command, None)
+    else:
+        randpic_select_modes[command] = mode
+    pic_selector.reset(command)
+    drop_prefetched(command)
+    await set_select_mode.send(f"{command}的选取模式已设置为{mode}（{SELECT_MODES[mode]}）")
+
+def migrate_file(fmd5: str, img_url: str) -> Tuple[Optional[str], str]:
+    """把一张旧图片移动到内容寻址存储，返回(新路径, moved/dedup/missing)"""
+    src = randpic_path / Path(img_url)
+    # 其他词条已迁移过同一张图片时直接引用
+    relpath = find_blob(randpic_path, fmd5)
+    if relpath is None:
+        if not src.exists():
+            return None, "missing"
+        relpath = blob_relpath(fmd5, src.suffix.lower() or ".jpg")
+    if src.exists() and not move_to_blob(randpic_path, src, relpath):
+        return relpath, "moved"
+    return relpath, "dedup"
+
+async def migrate_to_blob_store() -> Tuple[int, int, int]:
+    """把各词条目录下的旧图片迁移到内容寻址存储，返回(迁移数, 去重数, 缺失数)"""
+    global connection
+    cursor = await connection.cursor()
+    moved_count = dedup_count = missing_count = 0
+    updates: List[Tuple[str, int]] = []
+
+    await cursor.execute('SELECT id, md5, path FROM pictures WHERE substr(path, 1, ?) != ?',
+                         (len(BLOB_DIR_NAME) + 1, BLOB_DIR_NAME + "/"))
+    for picture_id, fmd5, img_url in await cursor.fetchall():
+        relpath, status = await run_io(migrate_file, fmd5, img_url)
+        if status == "missing":
+            logger.warning(f"{img_url}文件不存在，跳过")
+            missing_count += 1
+            continue
+        if status == "moved":
+            moved_count += 1
+        else:
+            dedup_count += 1
+        updates.append((relpath, picture_id))
+    async with randpic_write_lock:
+        await connection.executemany('UPDATE pictures SET path=? WHERE id=?', updates)
+        await connection.commit()
+
+    await cursor.close()
+    payload_cache.clear()
+    await rebuild_pic_index()
+    return moved_count, dedup_count, missing_count
+
+async def find_duplicate_clusters(command: str) -> List[List[str]]:
+    """补全词条中缺失的感知哈希，并按阈值把近似重复的图片聚类"""
+    global connection
+    cursor = await connection.cursor()
+    keyword_id = randpic_keyword_ids[command]
+    await cursor.execute('SELECT md5, path FROM pictures WHERE keyword_id=? AND phash IS NULL', (keyword_id,))
+    rows = await cursor.fetchall()
+    updates: List[Tuple[str, str]] = []
+    for fmd5, img_url in rows:
+        img = randpic_path / Path(img_url)
+        try:
+            data = await run_io(img.read_bytes)
+        except FileNotFoundError:
+            continue
+        phash = await run_io(dhash, data)
+        if phash is not None:
+            # 同一张图片在其他词条中的记录一并更新
+            updates.append((hash_to_hex(phash), fmd5))
+    async with randpic_write_lock:
+        await connection.executemany('UPDATE pictures SET phash=? WHERE md5=?', updates)
+        await connection.commit()
+    await cursor.close()
+    await rebuild_pic_index(command)
+
+    # 并查集合并BK树查询到的近似对
+    parent: Dict[str, str] = {}
+
+    def find(item: str) -> str:
+        while parent.setdefault(item, item) != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    tree = randpic_phash_index[command]
+    cursor = await connection.execute('SELECT path, phash FROM pictures WHERE keyword_id=? AND phash IS NOT NULL',
+                                      (keyword_id,))
+    for img_url, phash in await cursor.fetchall():
+        for _, other in tree.search(hex_to_hash(phash), config_dict.randpic_phash_threshold):
+            parent[find(other)] = find(img_url)
+    await cursor.close()
+
+    clusters: Dict[str, List[str]] = {}
+    for item in parent:
+        clusters.setdefault(find(item), []).append(item)
+    return [items for items in clusters.values() if len(items) > 1]
+
+# 查重命令
+check_duplicate = on_command("查重")
+
+@check_duplicate.handle()
+async def check_duplicate_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """扫描词条中的近似重复图片"""
+    command = str(args).strip()
+    if not command in randpic_command_set:
+        await check_duplicate.finish(f'"{command}"不是合法词条')
+        return
+    if Image is None:
+        await check_duplicate.finish("未安装Pillow，无法计算感知哈希")
+        return
+    if config_dict.randpic_phash_threshold < 0:
+        await check_duplicate.finish("近似去重已关闭")
+        return
+
+    clusters = await find_duplicate_clusters(command)
+    if not clusters:
+        await check_duplicate.finish(f"{command}中没有发现近似重复的图片")
+        return
+
+    lines = [f"{command}中发现{len(clusters)}组近似重复的图片："]
+    for i, items in enumerate(clusters[:20], start=1):
+        lines.append(f"{i}. " + ", ".join(Path(item).stem[:8] for item in items))
+    if len(clusters) > 20:
+        lines.append(f"... 还有 {len(clusters) - 20} 组")
+    await check_duplicate.send("\n".join(lines))
+
+# 迁移存储命令
+migrate_storage = on_command("迁移存储")
+
+@migrate_storage.handle()
+async def migrate_storage_handler(event: GroupMessageEvent):
+    """把旧的按词条存放的图片迁移到内容寻址存储"""
+    if event.user_id != 540729251:
+        await migrate_storage.finish("无权限执行")
+        return
+
+    await migrate_storage.send("开始迁移图片存储...")
+    moved_count, dedup_count, missing_count = await migrate_to_blob_store()
+    await migrate_storage.send(f"迁移完成！迁移{moved_count}张，去重{dedup_count}张，缺失{missing_count}张")
+
+async def run_bulk(*args: str) -> dict:
+    """在子进程中运行bulk.py，哈希计算和文件读写不占用bot进程，返回统计结果"""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, str(Path(__file__).with_name("bulk.py")), "--store", str(randpic_path), "--json", *args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    messages = stderr.decode(errors="replace").strip()
+    if process.returncode != 0:
+        raise RuntimeError(messages.splitlines()[-1] if messages else f"退出码{process.returncode}")
+    if messages:
+        logger.info(messages)
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+# 批量导入命令
+bulk_import = on_command("导入")
+
+@bulk_import.handle()
+async def bulk_import_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """从bot所在主机的目录或压缩包批量导入图片"""
+    if event.user_id != 540729251:
+        await bulk_import.finish("无权限执行")
+        return
+
+    args = str(args).split()
+    if len(args) not in (1, 2):
+        await bulk_import.finish("输入格式有误: /导入 <目录或压缩包路径> [词条]")
+        return
+    if len(args) == 2 and args[1] == BLOB_DIR_NAME:
+        await bulk_import.finish(f'"{args[1]}"为保留名称')
+        return
+    if not Path(args[0]).exists():
+        await bulk_import.finish(f"{args[0]}不存在")
+        return
+
+    bulk_args = ["import", args[0], "--phash-threshold", str(config_dict.randpic_phash_threshold)]
+    if len(args) == 2:
+        bulk_args += ["--keyword", args[1]]
+    await bulk_import.send("开始导入...")
+    try:
+        result = await run_bulk(*bulk_args)
+    except Exception as e:
+        logger.warning(f"导入失败: {e}")
+        await bulk_import.finish(f"导入失败: {e}")
+        return
+
+    await load_keywords()
+    for command in result["keywords"]:
+        await rebuild_pic_index(command)
+    await bulk_import.send(f"导入完成！新增{result['added']}张（{result['bytes'] / 1024 / 1024:.1f}MB），"
+                           f"重复{result['duplicate']}张，近似重复{result['similar']}张，失败{result['failed']}张，"
+                           f"用时{result['seconds']}秒\n涉及词条: {', '.join(result['keywords'])}")
+
+# 批量导出命令
+bulk_export = on_command("导出")
+
+@bulk_export.handle()
+async def bulk_export_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """把词条中的图片导出为bot所在主机上的压缩包"""
+    if event.user_id != 540729251:
+        await bulk_export.finish("无权限执行")
+        return
+
+    args = str(args).split()
+    if not args:
+        await bulk_export.finish("输入格式有误: /导出 <输出文件路径(.zip/.tar/.tar.gz)> [词条...]")
+        return
+    for command in args[1:]:
+        if not command in randpic_command_set:
+            await bulk_export.finish(f'"{command}"不是合法词条')
+            return
+
+    bulk_args = ["export", args[0]]
+    for command in args[1:]:
+        bulk_args += ["--keyword", command]
+    await bulk_export.send("开始导出...")
+    try:
+        result = await run_bulk(*bulk_args)
+    except Exception as e:
+        logger.warning(f"导出失败: {e}")
+        await bulk_export.finish(f"导出失败: {e}")
+        return
+    await bulk_export.send(f"导出完成！共{result['exported']}张（{result['bytes'] / 1024 / 1024:.1f}MB），"
+                           f"缺失{result['missing']}张，用时{result['seconds']}秒")
+
+# 重建索引命令
+rebuild_index = on_command("重建索引")
+
+@rebuild_index.handle()
+async def rebuild_index_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """从数据库重建图片索引"""
+    if event.user_id != 540729251:
+        await rebuild_index.finish("无权限执行")
+        return
+
+    command = str(args).strip()
+    if command and not command in randpic_command_set:
+        await rebuild_index.finish(f'"{command}"不是合法词条')
+        return
+
+    await rebuild_pic_index(command or None)
+    commands = [command] if command else randpic_command_list
+    total = sum(len(randpic_pic_index.get(cmd, [])) for cmd in commands)
+    await rebuild_index.send(f"索引重建完成，共{total}张图片")
+
+# 缓存统计命令
+cache_stats = on_command("randpic_cache", aliases={"图片缓存"})
+
+@cache_stats.handle()
+async def cache_stats_handler(event: GroupMessageEvent, args: Message = CommandArg()):
+    """查看或清空图片缓存"""
+    if str(args).strip() == "clear":
+        if event.user_id != 540729251:
+            await cache_stats.finish("无权限执行")
+            return
+        payload_cache.clear()
+        await cache_stats.finish("图片缓存已清空")
+
+    await cache_stats.send(payload_cache.stats())
+
 # 检查统计命令
 check_count_parser = ArgumentParser()
 check_count_parser.add_argument("--start_time", help="Start time in format YYYY-MM-DD HH:MM:SS", default=None)
@@ -270,32 +1163,128 @@ check_count_parser.add_argument("--user_id", type=int, help="User ID (integer)",
 
 check_count = on_shell_command("check_count", parser=check_count_parser)
 
+def parse_check_time(value: Optional[str]) -> Optional[datetime]:
+    """解析统计查询的时间参数（UTC，与日志时间一致）"""
+    if value is None:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(value)
+
 @check_count.handle()
 async def check_count_handler(event: GroupMessageEvent, args: Namespace = ShellCommandArgs()):
     """检查使用统计"""
     group_id = args.group_id if args.group_id else event.group_id
-    
+    try:
+        start_time = parse_check_time(args.start_time)
+        end_time = parse_check_time(args.end_time)
+    except ValueError:
+        await check_count.finish("时间格式有误，请使用 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS")
+        return
+    await flush_randpic_log()
+
+    # 起止时间都在整天边界上时查询天汇总表，否则按小时汇总表查询整点之间的部分，
+    # 不足一小时的首尾部分从原始日志中统计
+    if all(t is None or t == t.replace(hour=0, minute=0, second=0) for t in (start_time, end_time)):
+        table, bucket_format = "randpic_stats_daily", "%Y-%m-%d"
+        bucket_start, bucket_end = start_time, end_time
+    else:
+        table, bucket_format = "randpic_stats_hourly", "%Y-%m-%d %H:00:00"
+        bucket_start, bucket_end = start_time, end_time
+        if start_time is not None and start_time != start_time.replace(minute=0, second=0):
+            bucket_start = start_time.replace(minute=0, second=0) + timedelta(hours=1)
+        if end_time is not None:
+            bucket_end = end_time.replace(minute=0, second=0)
+
+    filters = ["group_id = ?"]
+    filter_params = [str(group_id)]
+    if args.user_id:
+        filters.append("caller_id = ?")
+        filter_params.append(str(args.user_id))
+
+    parts: List[str] = []
+    params: List[str] = []
+    if bucket_start is None or bucket_end is None or bucket_start < bucket_end:
+        conditions = list(filters)
+        params.extend(filter_params)
+        if bucket_start is not None:
+            conditions.append("bucket >= ?")
+            params.append(bucket_start.strftime(bucket_format))
+        if bucket_end is not None:
+            conditions.append("bucket < ?")
+            params.append(bucket_end.strftime(bucket_format))
+        parts.append(f'SELECT command, group_id, caller_id, count FROM {table} WHERE {" AND ".join(conditions)}')
+    # 起止时间在同一小时内时整个区间都从原始日志统计
+    raw_ranges = []
+    if bucket_start is not None and bucket_end is not None and bucket_start >= bucket_end:
+        raw_ranges.append((start_time, end_time))
+    else:
+        if start_time is not None and bucket_start != start_time:
+            raw_ranges.append((start_time, bucket_start))
+        if end_time is not None and bucket_end != end_time:
+            raw_ranges.append((bucket_end, end_time))
+    for range_start, range_end in raw_ranges:
+        parts.append(f'''SELECT command, group_id, caller_id, 1 AS count FROM randpic_log
+            WHERE {" AND ".join(filters)} AND time >= ? AND time < ?''')
+        params.extend(filter_params)
+        params.extend((range_start.strftime("%Y-%m-%d %H:%M:%S"), range_end.strftime("%Y-%m-%d %H:%M:%S")))
+
     global connection
     cursor = await connection.cursor()
-    await cursor.execute('''
-        SELECT command, group_id, caller_id, COUNT(*) AS count
-        FROM randpic_log
-        WHERE group_id = ?
+    await cursor.execute(f'''
+        SELECT command, group_id, caller_id, SUM(count) AS count
+        FROM ({" UNION ALL ".join(parts)})
         GROUP BY command, group_id, caller_id;
-    ''', (group_id, ))
+    ''', params)
     result = await cursor.fetchall()
     await cursor.close()
     await check_count.send(str(result))
 
+# 重建统计命令
+rebuild_stats = on_command("重建统计")
+
+@rebuild_stats.handle()
+async def rebuild_stats_handler(event: GroupMessageEvent):
+    """根据使用日志重建汇总表"""
+    if event.user_id != 540729251:
+        await rebuild_stats.finish("无权限执行")
+        return
+
+    await flush_randpic_log()
+    await backfill_randpic_stats()
+    await rebuild_stats.send("使用统计重建完成")
+
 # 检查词条数量命令
 checknsy = on_command("checknsy")
 
 @checknsy.handle()
 async def checknsy_handler(event: GroupMessageEvent, args: Message = CommandArg()):
     """检查各词条的图片数量"""
-    msg = "\n".join(f"{command}: {len(os.listdir(randpic_path / command))}" 
-                   for command in randpic_command_list)
-    await checknsy.send(msg)
+    global connection
+    cursor = await connection.execute('SELECT name, pic_count, total_bytes FROM keywords ORDER BY id')
+    counts = {name: (pic_count, total_bytes) for name, pic_count, total_bytes in await cursor.fetchall()}
+    await cursor.close()
+    lines = []
+    for command in randpic_command_list:
+        pic_count, total_bytes = counts.get(command, (0, 0))
+        lines.append(f"{command}: {pic_count} ({total_bytes / 1024 / 1024:.1f}MB)")
+    await checknsy.send("\n".join(lines))
+
+# 核对存储命令
+reconcile = on_command("核对存储")
+
+@reconcile.handle()
+async def reconcile_handler(event: GroupMessageEvent):
+    """核对数据库统计与磁盘文件"""
+    if event.user_id != 540729251:
+        await reconcile.finish("无权限执行")
+        return
+
+    report = await reconcile_storage()
+    await reconcile.send("\n".join(report) if report else "存储核对完成，未发现差异")
 
 # 添加图片命令
 add = on_command("添加", aliases={"add", "加图"})
@@ -318,53 +1307,120 @@ async def add_pic(state: T_State, pic_list: Message = Arg('pic')):
     command = state["keyword"]
 
     await create_command(command)
+    keyword_id = randpic_keyword_ids[command]
 
     succ_count = 0
     fail_count = 0
+    fail_reasons: List[str] = []
 
+    pic_urls: List[str] = []
     for pic_name in pic_list:
         if pic_name.type != 'image':
             await add.send(pic_name + MessageSegment.text("\n输入格式有误，请重新触发指令！"), at_sender=True)
             continue
-        
-        pic_url = pic_name.data['url']
+        pic_urls.append(pic_name.data['url'])
 
-        async with AsyncClient() as client:
-            resp = await client.get(pic_url, timeout=5.0)
+    # 使用共享连接池并发下载，限制同时进行的下载数
+    semaphore = asyncio.Semaphore(config_dict.randpic_download_concurrency)
 
-        try:
+    async def download(pic_url: str) -> bytes:
+        async with semaphore:
+            resp = await http_client.get(pic_url)
             resp.raise_for_status()
-        except Exception as e:
-            logger.warning(e)
+            return resp.content
+
+    results = await asyncio.gather(*(download(pic_url) for pic_url in pic_urls), return_exceptions=True)
+
+    # 新图片先记录在内存中，最后在写锁内一次性插入并更新词条统计
+    added_rows: List[Tuple[int, str, str, int, Optional[str]]] = []
+    added_md5s: Dict[str, str] = {}  # 本批已接收的图片 md5 -> 路径
+    added_indexes: List[int] = []  # 与added_rows对应的图片序号
+    for index, (pic_url, data) in enumerate(zip(pic_urls, results), start=1):
+        if isinstance(data, Exception):
+            logger.warning(data)
             fail_count += 1
+            fail_reasons.append(f"第{index}张：下载失败")
             continue
 
-        data = resp.content
-        fmd5 = hashlib.md5(data).hexdigest()
+        fmd5 = await run_io(lambda: hashlib.md5(data).hexdigest())
 
-        await cursor.execute(f'SELECT img_url FROM Pic_of_{command} where md5=?', (fmd5,))
+        await cursor.execute('SELECT 1 FROM pictures WHERE keyword_id=? AND md5=?', (keyword_id, fmd5))
         status = await cursor.fetchone()
 
-        if status is not None:
+        if status is not None or fmd5 in added_md5s:
             fail_count += 1
-        else:
-            without_extension, extension = os.path.splitext(pic_url)
-            randpic_cur_picnum = len(os.listdir(randpic_path / command))
-            file_name = (randpic_filename.format(command=command, index=str(randpic_cur_picnum + 1))
-                        + (extension if extension != '' else '.jpg'))
-            file_path = randpic_path / command / file_name
+            fail_reasons.append(f"第{index}张：图片已存在")
+            continue
+
+        # 感知哈希近似去重，解码图片较耗CPU，放到线程池中执行
+        phash = None
+        if config_dict.randpic_phash_threshold >= 0:
+            phash = await run_io(dhash, data)
+        tree = randpic_phash_index.setdefault(command, BKTree())
+        if phash is not None and tree.search(phash, config_dict.randpic_phash_threshold):
+            fail_count += 1
+            fail_reasons.append(f"第{index}张：与已有图片近似重复")
+            continue
 
+        try:
+            # 按内容寻址存储，其他词条已有同一张图片时直接引用
+            await cursor.execute('SELECT path FROM pictures WHERE md5=? LIMIT 1', (fmd5,))
+            row = await cursor.fetchone()
+            db_path = row[0] if row else await run_io(find_blob, randpic_path, fmd5)
+            if db_path is None:
+                db_path = blob_relpath(fmd5, guess_extension(data))
+                await run_io(write_blob, randpic_path, db_path, data)
+                if config_dict.randpic_transcode_on_ingest:
+                    await resolve_send_file(db_path)
+            added_rows.append((keyword_id, fmd5, db_path, len(data),
+                               hash_to_hex(phash) if phash is not None else None))
+            added_md5s[fmd5] = db_path
+            added_indexes.append(index)
+            if phash is not None:
+                tree.add(phash, db_path)
+            succ_count += 1
+        except Exception as e:
+            logger.warning(e)
+            fail_count += 1
+            fail_reasons.append(f"第{index}张：保存失败")
+
+    # 查重在写锁外进行，其他添加流程可能已插入同一张图片，逐行插入并忽略冲突的行
+    committed = True
+    inserted = [False] * len(added_rows)
+    inserted_rows: List[Tuple[int, str, str, int, Optional[str]]] = []
+    if added_rows:
+        async with randpic_write_lock:
             try:
-                with file_path.open("wb") as f:
-                    f.write(data)
-                # 使用正斜杠确保跨平台兼容性
-                db_path = f"{command}/{file_name}".replace("\\", "/")
-                await cursor.execute(f'insert or replace into Pic_of_{command}(md5, img_url) values (?, ?)',
-                                   (fmd5, db_path))
+                for position, row in enumerate(added_rows):
+                    insert_cursor = await connection.execute(
+                        'INSERT OR IGNORE INTO pictures (keyword_id, md5, path, size, phash) VALUES (?, ?, ?, ?, ?)', row)
+                    if insert_cursor.rowcount == 1:
+                        inserted[position] = True
+                        inserted_rows.append(row)
+                    await insert_cursor.close()
+                await connection.execute(
+                    'UPDATE keywords SET pic_count = pic_count + ?, total_bytes = total_bytes + ? WHERE id=?',
+                    (len(inserted_rows), sum(row[3] for row in inserted_rows), keyword_id))
                 await connection.commit()
-                succ_count += 1
             except Exception as e:
                 logger.warning(e)
+                await connection.rollback()
+                committed = False
+    if committed:
+        randpic_pic_index.setdefault(command, []).extend(row[2] for row in inserted_rows)
+        for index, row_inserted in zip(added_indexes, inserted):
+            if not row_inserted:
+                succ_count -= 1
                 fail_count += 1
-    
-    await add.send(f"{command}添加完成！成功{succ_count}张，失败{fail_count}张") 
\ No newline at end of file
+                fail_reasons.append(f"第{index}张：图片已存在")
+    else:
+        # 感知哈希索引中已加入本批图片，按数据库重建
+        await rebuild_pic_index(command)
+        fail_count += succ_count
+        succ_count = 0
+        fail_reasons.append("数据库写入失败")
+
+    result = f"{command}添加完成！成功{succ_count}张，失败{fail_count}张"
+    if fail_reasons:
+        result += "\n" + "\n".join(fail_reasons)
+    await add.send(result) 
\ No newline at end of file
@@ -0,0 +1,167 @@
+import random
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+SELECT_MODES = {
+    "uniform": "均匀随机",
+    "shuffle": "洗牌（每个群在发完所有图片前不重复）",
+    "recency": "避开本群最近发过的图片",
+    "least_sent": "优先发送次数最少的图片",
+}
+
+
+class ShuffleBag:
+    """洗牌：用Feistel网络把[0, n)映射为一个由密钥决定的伪随机排列，按位置依次取出，每一轮换一个新的随机密钥
+
+    每个群只保存密钥、位置和图片数量，占用与图片数量无关；网络的定义域取不小于n的4的幂，
+    映射到n以外时继续迭代直到落回[0, n)（cycle-walking），平均不超过4次。
+    """
+
+    ROUNDS = 6  # 轮函数较简单，少于6轮时较小的n上排列分布明显不均匀
+
+    __slots__ = ("n", "half", "key", "pos")
+
+    def __init__(self, n: int):
+        self._restart(n)
+
+    def _restart(self, n: int):
+        self.n = n
+        self.half = max(1, ((n - 1).bit_length() + 1) // 2)  # 左右两半各自的位数
+        self.key = random.getrandbits(32 * self.ROUNDS)
+        self.pos = 0
+
+    def _permute(self, value: int) -> int:
+        half = self.half
+        mask = (1 << half) - 1
+        left, right = value >> half, value & mask
+        for round_index in range(self.ROUNDS):
+            # 轮函数：右半与本轮密钥异或后做MurmurHash3的32位末尾混合
+            mixed = (right ^ (self.key >> (32 * round_index))) & 0xFFFFFFFF
+            mixed = (mixed * 0x85EBCA6B) & 0xFFFFFFFF
+            mixed ^= mixed >> 13
+            mixed = (mixed * 0xC2B2AE35) & 0xFFFFFFFF
+            mixed ^= mixed >> 16
+            left, right = right, left ^ (mixed & mask)
+        return (left << half) | right
+
+    def next(self, n: int) -> int:
+        if n != self.n:
+            # 图片数量变化后重新开始一轮
+            self._restart(n)
+        elif self.pos >= n:
+            self.key = random.getrandbits(32 * self.ROUNDS)
+            self.pos = 0
+        index = self._permute(self.pos)
+        while index >= n:
+            index = self._permute(index)
+        self.pos += 1
+        return index
+
+
+class RecentWindow:
+    """记录最近发送过的若干张图片，抽样时尽量避开"""
+
+    __slots__ = ("size", "recent")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.recent: "OrderedDict[int, None]" = OrderedDict()
+
+    def next(self, n: int, tries: int = 8) -> int:
+        # 窗口不超过图片数量的一半，保证期望抽样次数为常数
+        window = min(self.size, n // 2)
+        while len(self.recent) > window:
+            self.recent.popitem(last=False)
+        index = random.randrange(n)
+        for _ in range(tries):
+            if index not in self.recent:
+                break
+            index = random.randrange(n)
+        self.recent.pop(index, None)
+        self.recent[index] = None
+        if len(self.recent) > window:
+            self.recent.popitem(last=False)
+        return index
+
+
+class LeastSentPicker:
+    """按发送次数分桶，从次数最少的桶中随机取一张，取出和计数均为O(1)，最少次数的桶始终非空"""
+
+    def __init__(self):
+        self.counts: List[int] = []
+        self.positions: List[int] = []
+        self.buckets: Dict[int, List[int]] = {}
+        self.min_count = 0
+
+    def _grow(self, n: int):
+        # 新图片以当前最小次数加入，避免新图被连续发送
+        for index in range(len(self.counts), n):
+            bucket = self.buckets.setdefault(self.min_count, [])
+            self.counts.append(self.min_count)
+            self.positions.append(len(bucket))
+            bucket.append(index)
+
+    def next(self, n: int) -> int:
+        if n < len(self.counts):
+            self.__init__()
+        self._grow(n)
+        bucket = self.buckets[self.min_count]
+        index = bucket[random.randrange(len(bucket))]
+
+        # 交换到桶尾后删除
+        position = self.positions[index]
+        last = bucket[-1]
+        bucket[position] = last
+        self.positions[last] = position
+        bucket.pop()
+
+        count = self.counts[index] + 1
+        self.counts[index] = count
+        next_bucket = self.buckets.setdefault(count, [])
+        self.positions[index] = len(next_bucket)
+        next_bucket.append(index)
+        if not bucket:
+            # 最少次数的桶已取空，最小次数就是刚加一的次数
+            del self.buckets[self.min_count]
+            self.min_count = count
+        return index
+
+
+class PicSelector:
+    """按词条的选取模式返回图片下标，按群保存的状态数量有上限"""
+
+    def __init__(self, max_states: int, recent_size: int):
+        self.max_states = max_states
+        self.recent_size = recent_size
+        self._group_states: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._least_sent: Dict[str, LeastSentPicker] = {}
+
+    def _group_state(self, key: Hashable, factory):
+        state = self._group_states.get(key)
+        if state is None:
+            state = factory()
+            self._group_states[key] = state
+            while len(self._group_states) > self.max_states:
+                self._group_states.popitem(last=False)
+        else:
+            self._group_states.move_to_end(key)
+        return state
+
+    def pick(self, mode: str, command: str, group_id: int, n: int) -> int:
+        if mode == "shuffle":
+            return self._group_state(("shuffle", command, group_id), lambda: ShuffleBag(n)).next(n)
+        if mode == "recency":
+            return self._group_state(("recency", command, group_id), lambda: RecentWindow(self.recent_size)).next(n)
+        if mode == "least_sent":
+            return self._least_sent.setdefault(command, LeastSentPicker()).next(n)
+        return random.randrange(n)
+
+    def reset(self, command: Optional[str] = None):
+        """图片列表重建后下标失效，清空相关状态"""
+        if command is None:
+            self._group_states.clear()
+            self._least_sent.clear()
+            return
+        self._least_sent.pop(command, None)
+        for key in [key for key in self._group_states if key[1] == command]:
+            del self._group_states[key]
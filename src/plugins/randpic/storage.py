@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+# 内容寻址存储目录，图片按md5分片存放，同一张图片只存一份
+BLOB_DIR_NAME = "_blobs"
+
+_MAGIC_EXTENSIONS = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"BM", ".bmp"),
+)
+
+
+def guess_extension(data: bytes, default: str = ".jpg") -> str:
+    """根据文件头判断图片扩展名"""
+    for magic, extension in _MAGIC_EXTENSIONS:
+        if data.startswith(magic):
+            return extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return default
+
+
+def blob_relpath(md5: str, extension: str) -> str:
+    """图片在存储目录下的相对路径，形如 _blobs/ab/cd/abcd....jpg"""
+    return f"{BLOB_DIR_NAME}/{md5[:2]}/{md5[2:4]}/{md5}{extension}"
+
+
+def find_blob(root: Path, md5: str) -> Optional[str]:
+    """查找已存储的图片，只扫描md5所在的分片目录"""
+    shard = root / BLOB_DIR_NAME / md5[:2] / md5[2:4]
+    try:
+        names = os.listdir(shard)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        # 派生文件名中带有额外后缀，stem不等于md5
+        if Path(name).stem == md5:
+            return f"{BLOB_DIR_NAME}/{md5[:2]}/{md5[2:4]}/{name}"
+    return None
+
+
+def _write_atomic(path: Path, write):
+    """写入唯一的临时文件再原子替换；同一张图片被同时写入时，替换失败但目标已存在视为成功"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_name, path)
+    except OSError:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        if not path.exists():
+            raise
+
+
+def write_blob(root: Path, relpath: str, data: bytes):
+    """写入图片，先写临时文件再原子替换，已存在时跳过"""
+    path = root / relpath
+    if path.exists():
+        return
+    _write_atomic(path, lambda f: f.write(data))
+
+
+def move_to_blob(root: Path, src: Path, relpath: str) -> bool:
+    """把已有文件移动到存储目录，目标已存在时删除源文件，返回是否发生了去重"""
+    dest = root / relpath
+    if dest.exists():
+        src.unlink()
+        return True
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src, dest)
+    return False
+
+
+def copy_to_blob(root: Path, src: Path, relpath: str):
+    """复制外部文件到存储目录，先写临时文件再原子替换，已存在时跳过"""
+    path = root / relpath
+    if path.exists():
+        return
+
+    def copy(f):
+        with open(src, "rb") as source:
+            shutil.copyfileobj(source, f)
+
+    _write_atomic(path, copy)
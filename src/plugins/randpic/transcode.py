@@ -0,0 +1,70 @@
+import os
+import tempfile
+from pathlib import Path, PurePosixPath
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:  # Pillow为可选依赖，未安装时不转码
+    Image = None
+
+_FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+def derivative_relpath(relpath: str, fmt: str, max_dimension: int, quality: int) -> str:
+    """派生文件与原图放在同一目录，文件名带上转码参数，修改配置后会重新生成"""
+    path = PurePosixPath(relpath)
+    extension = ".gif" if path.suffix.lower() == ".gif" else _FORMAT_EXTENSIONS.get(fmt.upper(), ".jpg")
+    return str(path.with_name(f"{path.stem}.d{max_dimension}q{quality}{extension}"))
+
+
+def _save_atomic(dest: Path, save):
+    # 每次写入使用唯一的临时文件，同一张图片被同时转码时互不影响
+    fd, tmp_name = tempfile.mkstemp(dir=dest.parent, prefix=dest.name + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        save(tmp_name)
+        os.replace(tmp_name, dest)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+def transcode(src: Path, dest: Path, fmt: str, max_dimension: int, quality: int, gif_max_frames: int) -> bool:
+    """生成压缩后的派生文件，派生文件不比原图小时不保留，返回是否生成成功"""
+    if Image is None:
+        return False
+    fmt = fmt.upper()
+    with Image.open(src) as img:
+        if dest.suffix == ".gif":
+            # GIF保持原格式，缩小尺寸并限制帧数
+            frames = []
+            durations = []
+            for frame in ImageSequence.Iterator(img):
+                if len(frames) >= gif_max_frames:
+                    break
+                durations.append(frame.info.get("duration", img.info.get("duration", 100)))
+                frame = frame.convert("RGBA")
+                frame.thumbnail((max_dimension, max_dimension))
+                frames.append(frame)
+            _save_atomic(dest, lambda path: frames[0].save(
+                path, format="GIF", save_all=True, append_images=frames[1:],
+                duration=durations, loop=img.info.get("loop", 0), optimize=True, disposal=2))
+        elif getattr(img, "is_animated", False):
+            # 其他格式的动图转成静态图会丢失动画，不处理
+            return False
+        else:
+            frame = img.copy()
+            frame.thumbnail((max_dimension, max_dimension))
+            if fmt == "JPEG" and frame.mode != "RGB":
+                # JPEG不支持透明通道，铺白色背景
+                background = Image.new("RGB", frame.size, (255, 255, 255))
+                rgba = frame.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                frame = background
+            _save_atomic(dest, lambda path: frame.save(path, format=fmt, quality=quality, optimize=True))
+
+    if dest.stat().st_size >= src.stat().st_size:
+        dest.unlink()
+        return False
+    return True
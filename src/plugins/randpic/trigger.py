@@ -0,0 +1,53 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+_END = ""  # 词条结束标记，普通字符不会是空串
+
+
+class TriggerTrie:
+    """词条和别名的前缀树，启动和词条/别名变更时重建，匹配耗时只与词条长度有关"""
+
+    def __init__(self):
+        self._root: Dict[str, dict] = {}
+        self.max_length = 0
+
+    @classmethod
+    def build(cls, commands: Iterable[str], aliases: Dict[str, str]) -> "TriggerTrie":
+        trie = cls()
+        for alias, command in aliases.items():
+            trie.add(alias, command)
+        # 词条优先于同名别名
+        for command in commands:
+            trie.add(command, command)
+        return trie
+
+    def add(self, word: str, command: str):
+        if not word:
+            return
+        node = self._root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[_END] = command
+        self.max_length = max(self.max_length, len(word))
+
+    def match(self, text: str) -> Optional[str]:
+        """完全匹配"""
+        if len(text) > self.max_length:
+            return None
+        node = self._root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(_END)
+
+    def match_prefix(self, text: str) -> Optional[Tuple[str, str]]:
+        """最长前缀匹配，返回(匹配到的词条或别名, 对应词条)"""
+        node = self._root
+        result = None
+        for index, char in enumerate(text[:self.max_length]):
+            node = node.get(char)
+            if node is None:
+                break
+            if _END in node:
+                result = (text[:index + 1], node[_END])
+        return result